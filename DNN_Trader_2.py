@@ -1,150 +1,260 @@
+import os
 import pandas as pd
 import numpy as np
 import tpqoa
 from datetime import datetime, timedelta
 import time
+from time import perf_counter
 import pickle
-import pymysql
-import uuid
-from statsmodels.tsa.arima.model import ARIMA
-from tensorflow import keras
+from buffers import TickBuffer, FrameBuffer
+from bars import BarBuilder
+from history_cache import HistoryCache
+from journal import TradeJournal, MySQLBackend
+from indicators import DNNFeatures
+from inference import lag_matrix, EnsembleScorer
+from pipeline import BarPipeline
+from metrics import Metrics
+from models import LazyModel, exported
+from snapshot import Snapshot
+from orders import OrderManager, TraderBroker
+from retrain import Retrainer, fit_ensemble, portable
 
 class DNNTrader2(tpqoa.tpqoa):
-    def __init__(self, conf_file, instrument, bar_length, window, lags, LR_model, DNN_model , RF_model , mu, std, units , Comb_Str):
+    def __init__(self, conf_file, instrument, bar_length, window, lags, LR_model, DNN_model , RF_model , mu, std, units , Comb_Str, max_bars = 10000, cache_dir = "history", journal_backend = None, metrics_port = None, metrics_file = None, snapshot = None, snapshot_every = 5, snapshot_background = True, retrain_every = None, retrain_window = None, retrain_background = True, broker = None, order_timeout = 10, order_retries = 3, order_background = True, frame_dtype = np.float32):
         super().__init__(conf_file)
         self.instrument = instrument
         self.bar_length = pd.to_timedelta(bar_length)
-        self.tick_data = pd.DataFrame()
+        self.tick_data = TickBuffer()
+        self.bars = BarBuilder(bar_length, capacity = max_bars)
+        self.cache = HistoryCache(cache_dir) # local candle store, only the missing tail is downloaded
         self.raw_data = None
         self.data = None 
         self.last_bar = None
         self.units = units
         self.position = 0
         self.profits = []
+        self.journal = TradeJournal(journal_backend or MySQLBackend(), "TradesTable_DNN_{}".format(instrument))
+        self.metrics = Metrics({"instrument": instrument}) # per-stage latencies (p50/p99), Prometheus export
+        if metrics_port is not None:
+            self.metrics.serve(metrics_port)
+        if metrics_file is not None:
+            self.metrics.export(metrics_file)
+        self.tick_clock = None # arrival of the tick being handled, for the tick-to-order latency
+        self.snapshot = Snapshot(snapshot, snapshot_every, snapshot_background) if snapshot else None # crash-safe state file
+        self._snapshot_filled = 0 # filled units in the last snapshot
+        # orders leave from a background thread (broker: create_order of this class unless given)
+        self.order_manager = OrderManager(broker or TraderBroker(self), instrument, timeout = order_timeout,
+                                          retries = order_retries, on_fill = self.order_filled, metrics = self.metrics,
+                                          background = order_background)
         self.Comb_Str = Comb_Str
         #*****************add strategy-specific attributes here******************
         self.window = window
         self.lags = lags
-        self.LR_model = LR_model
-        self.DNN_model = DNN_model 
-        self.RF_model = RF_model
+        # model objects or files; files load in the background while get_most_recent downloads
+        self.LR_model = LazyModel(LR_model)
+        self.DNN_model = LazyModel(DNN_model)
+        self.RF_model = LazyModel(RF_model)
         self.mu = mu
         self.std = std
+        self.features = DNNFeatures(window, capacity = max_bars)
+        self.feature_names = ["dir", "sma", "boll", "min", "max", "mom", "vol"]
+        self.cols = ["{}_lag_{}".format(f, lag) for f in self.feature_names for lag in range(1, lags + 1)]
+        timed = self.metrics.timed
+        self.scorer = EnsembleScorer(self.cols, {"proba": timed("DNN", lambda X: self.DNN_model.predict(X, verbose = 0)),
+                                                 "LR_position": timed("LR", lambda X: self.LR_model.predict(X)),
+                                                 "RF_position": timed("RF", lambda X: self.RF_model.predict(X))}, mu, std)
+        # signal rows of the last bars (self.data), as long as the longest lookback (150-bar SMA)
+        self.signals = FrameBuffer(self.features.warmup, ["proba", "LR_position", "RF_position", "DNN_position", "position"],
+                                   dtype = frame_dtype)
+        self.dnn_position = 0 # last DNN position of a live bar, carried forward without a strong signal
+        # mu / std, DNN, LR and RF refitted every retrain_every bars on the last retrain_window bars (off by default)
+        self.retrainer = Retrainer(fit_ensemble, every = retrain_every, background = retrain_background,
+                                   metrics = self.metrics, tag = "DNN_" + instrument) if retrain_every else None
+        self.retrain_window = retrain_window or max_bars
         #************************************************************************
     
+    def utcnow(self): # wall clock; replay.py runs the trader on the clock of the replayed ticks
+        return datetime.utcnow()
+    
     def get_most_recent(self, days = 5):
+        resumed = self.restore_snapshot(days)
         while True:
             time.sleep(2)
-            now = datetime.utcnow()
+            now = self.utcnow()
             now = now - timedelta(microseconds = now.microsecond)
             past = now - timedelta(days = days)
-            df = self.get_history(instrument = self.instrument, start = past, end = now,
-                                   granularity = "S5", price = "M", localize = False).c.dropna().to_frame()
+            if resumed: # only the bars missed since the snapshot
+                past = (self.last_bar - self.bar_length).tz_localize(None).to_pydatetime()
+            df = self.cache.get_history(self, instrument = self.instrument, start = past, end = now,
+                                        granularity = "S5", price = "M").c.dropna().to_frame()
             df.rename(columns = {"c":self.instrument}, inplace = True)
-            df = df.resample(self.bar_length, label = "right").last().dropna().iloc[:-1]
-            self.raw_data = df.copy()
-            self.last_bar = self.raw_data.index[-1]
-            if pd.to_datetime(datetime.utcnow()).tz_localize("UTC") - self.last_bar < self.bar_length:
-                self.start_time = pd.to_datetime(datetime.utcnow()).tz_localize("UTC") # NEW -> Start Time of Trading Session
+            if resumed:
+                self.bars.backfill(df[self.instrument])
+            else:
+                self.bars.load(df[self.instrument])
+            self.raw_data = self.bars.frame(self.instrument)
+            self.last_bar = self.bars.last_time()
+            if pd.to_datetime(self.utcnow()).tz_localize("UTC") - self.last_bar < self.bar_length:
+                if not resumed: # a resumed session keeps its start time
+                    self.start_time = pd.to_datetime(self.utcnow()).tz_localize("UTC") # NEW -> Start Time of Trading Session
                 break
+        self.features.sync(self.bars.history) # warm up the incremental features
+    
+    def snapshot_state(self):
+        # only the rows a restore reads: the rolling windows, the lags and the retraining window
+        features = max(self.lags + 1, self.retrain_window if self.retrainer is not None else 0)
+        buffers = {"bars": (self.bars.history, self.features.warmup), "features": (self.features.history, features),
+                   "signals": self.signals}
+        meta = {"instrument": self.instrument, "bar_length": str(self.bar_length), "filled": self.order_manager.position,
+                "profits": self.profits, "dnn_position": float(self.dnn_position), "start_time": str(self.start_time),
+                "models": {name: model.source for name, model in self.models().items() if isinstance(model.source, str)},
+                "mu": dict(zip(self.cols, self.scorer.mu.tolist())), "std": dict(zip(self.cols, self.scorer.std.tolist()))}
+        return buffers, meta
+    
+    def restore_snapshot(self, days = 5):
+        # resume bars, features, signals, position and P&L from the snapshot of this
+        # instrument if it is less than `days` old; False means a full warm-up is needed
+        state = self.snapshot.load() if self.snapshot is not None else None
+        if state is None:
+            return False
+        buffers, meta = state
+        last_bar = pd.Timestamp(int(buffers["bars"][0][-1]), tz = "UTC")
+        if (meta["instrument"], meta["bar_length"]) != (self.instrument, str(self.bar_length)) \
+                or pd.Timestamp(self.utcnow(), tz = "UTC") - last_bar > pd.Timedelta(days = days):
+            return False
+        self.bars.history.load(*buffers["bars"])
+        self.features.restore(*buffers["features"], self.bars.history)
+        self.signals.load(*buffers["signals"])
+        self.order_manager.position = meta["filled"] # held at the broker already, pending orders are sent again
+        self.position = int(np.sign(meta["filled"]))
+        self.profits = meta["profits"]
+        self.dnn_position = meta["dnn_position"]
+        self.start_time = pd.Timestamp(meta["start_time"])
+        for name, path in meta.get("models", {}).items(): # retrained models and their standardization
+            if path != getattr(self, name).source and os.path.exists(path):
+                setattr(self, name, LazyModel(path))
+        if "mu" in meta:
+            self.set_params(pd.Series(meta["mu"]), pd.Series(meta["std"]))
+        self.last_bar = last_bar
+        print("Resumed from {} | last bar = {} | position = {} | Cum P&L = {}".format(
+            self.snapshot.path, last_bar, self.position, sum(self.profits)))
+        return True
                 
     def on_success(self, time, bid, ask):
+        self.tick_clock = perf_counter()
         print(self.ticks, end = " ", flush = True)
         
         recent_tick = pd.to_datetime(time)
-        df = pd.DataFrame({self.instrument:(ask + bid)/2}, 
-                          index = [recent_tick])
-        self.tick_data = self.tick_data.append(df)
+        price = (ask + bid)/2
+        self.tick_data.append(recent_tick, price)
         
-        if recent_tick - self.last_bar > self.bar_length:
+        if self.bars.update(recent_tick, price): # a bar has just been completed
             self.resample_and_join()
             self.define_strategy()
             self.execute_trades()
+        self.metrics.observe("on_success", perf_counter() - self.tick_clock)
     
     def resample_and_join(self):
-        self.raw_data = self.raw_data.append(self.tick_data.resample(self.bar_length, 
-                                                                  label="right").last().ffill().iloc[:-1])
-        self.tick_data = self.tick_data.iloc[-1:]
-        self.last_bar = self.raw_data.index[-1]
+        with self.metrics.timer("resample_and_join"):
+            self.raw_data = self.bars.frame(self.instrument) # bounded view of the finished bars
+            self.tick_data.keep_last()
+            self.last_bar = self.bars.last_time()
     
     def define_strategy(self): # "strategy-specific"
-        df = self.raw_data.copy()
-        
-        #******************** define your strategy here ************************
-        #create features
-        df = df.append(self.tick_data) # append latest tick (== open price of current bar)
-        df["returns"] = np.log(df[self.instrument] / df[self.instrument].shift())
-        df["dir"] = np.where(df["returns"] > 0, 1, -1)
-        df["sma"] = df[self.instrument].rolling(self.window).mean() - df[self.instrument].rolling(150).mean()
-        df["boll"] = (df[self.instrument] - df[self.instrument].rolling(self.window).mean()) / df[self.instrument].rolling(self.window).std()
-        df["min"] = df[self.instrument].rolling(self.window).min() / df[self.instrument] - 1
-        df["max"] = df[self.instrument].rolling(self.window).max() / df[self.instrument] - 1
-        df["mom"] = df["returns"].rolling(3).mean()
-        df["vol"] = df["returns"].rolling(self.window).std()
-        df.dropna(inplace = True)
-        
-        # create lags
-        self.cols = []
-        features = ["dir", "sma", "boll", "min", "max", "mom", "vol"]
-
-        for f in features:
-            for lag in range(1, self.lags + 1):
-                col = "{}_lag_{}".format(f, lag)
-                df[col] = df[f].shift(lag)
-                self.cols.append(col)
-        df.dropna(inplace = True)
+        with self.metrics.timer("define_strategy"):
+            self._define_strategy()
+    
+    def _define_strategy(self):
+        with self.metrics.timer("features"):
+            new_bars = self.features.sync(self.bars.history) # O(1) update per new bar
         
-        # standardization
-        df_s = (df - self.mu) / self.std
-        # predict
-        df["proba"] = self.DNN_model.predict(df_s[self.cols])
+        with self.metrics.timer("swap_models"): # between two bars, never in the middle of one
+            self.swap_models()
         
-        #determine positions
-        #************************ logistic Regression Model ********************
-        df["LR_position"] = self.LR_model.predict(df_s[self.cols])
+        #******************** define your strategy here ************************
+        # lags of the new bars and of the latest tick (== open price of current bar),
+        # read from a strided view over the feature history
+        history = self.features.history
+        X = lag_matrix([history.column(f) for f in self.feature_names], self.lags, rows = new_bars + 1, next_row = True)
+        times = history.index(len(X) - 1).append(pd.DatetimeIndex([self.tick_data.last_time()]))
         
-        #************************ Random Forest Model **************************
-        df["RF_position"] = self.RF_model.predict(df_s[self.cols])
+        # standardization and prediction of the new rows only, one batched call per model
+        # (each model is timed on its own: DNN, LR, RF)
+        pred = self.scorer.predict(X)
         
         #**************************** DNN _ Method *****************************
-        df = df.loc[self.start_time:].copy() # starting with first live_stream bar (removing historical bars)
-        df["DNN_position"] = np.where(df.proba < 0.50, -1, np.nan)
-        df["DNN_position"] = np.where(df.proba > 0.51, 1, df.DNN_position)
-        df["DNN_position"] = df.DNN_position.ffill().fillna(0) # start with neutral position if no strong signal
+        dnn = np.where(pred["proba"] < 0.50, -1, np.nan)
+        dnn = np.where(pred["proba"] > 0.51, 1, dnn)
+        live = np.asarray(times >= self.start_time) # starting with first live_stream bar (removing historical bars)
+        carry = self.dnn_position
+        for i in np.flatnonzero(live):
+            if np.isnan(dnn[i]):
+                dnn[i] = carry # start with neutral position if no strong signal
+            elif i < len(dnn) - 1:
+                carry = dnn[i]
+        self.dnn_position = carry
         
         #************************************************************************  
         if self.Comb_Str == 1:
-            df['position'] = np.where((df['LR_position']==df['DNN_position']) & (df['DNN_position'] == df['RF_position']),df['DNN_position'],0)                                                    
+            position = np.where((pred["LR_position"] == dnn) & (dnn == pred["RF_position"]), dnn, 0)
         elif self.Comb_Str == 2:
-            df['position'] = np.sign(df['LR_position'] + df['DNN_position'] + df['RF_position'])  
+            position = np.sign(pred["LR_position"] + dnn + pred["RF_position"])
         
-        self.data = df.copy()
+        rows = {"proba": pred["proba"], "LR_position": pred["LR_position"], "RF_position": pred["RF_position"],
+                "DNN_position": dnn, "position": position}
+        done = live[:-1] # finished bars are kept, the tick row is recomputed on the next bar
+        self.signals.extend(times[:-1][done], {col: val[:-1][done] for col, val in rows.items()})
+        tick = pd.DataFrame({col: val[-1:] for col, val in rows.items()}, index = times[-1:])
+        self.data = pd.concat([self.signals.frame(), tick]) # bounded by the signals ring
+        if self.retrainer is not None:
+            self.retrainer.update(new_bars, self.retrain_data)
+    
+    def models(self):
+        return {"LR_model": self.LR_model, "DNN_model": self.DNN_model, "RF_model": self.RF_model}
+    
+    def set_params(self, mu, std):
+        self.mu = mu
+        self.std = std
+        self.scorer.set_params(mu, std)
+    
+    def retrain_data(self):
+        # training window of the background refit, copied since the buffers keep moving
+        history = self.features.history
+        features = {f: history.column(f)[-self.retrain_window:].copy() for f in ["returns"] + self.feature_names}
+        return {"features": features, "names": self.feature_names, "cols": self.cols, "mu": self.mu, "std": self.std,
+                "current": {name: portable(model) for name, model in self.models().items()}}
+    
+    def swap_models(self):
+        # all refitted models and their mu / std at once; the scorer reads self.*_model on every call
+        swap = self.retrainer.poll() if self.retrainer is not None else None
+        if swap is not None:
+            models, params = swap
+            for name, model in models.items():
+                setattr(self, name, model)
+            if params is not None:
+                self.set_params(params["mu"], params["std"])
     
     def execute_trades(self):
-        if self.data["position"].iloc[-1] == 1:
-            if self.position == 0:
-                order = self.create_order(self.instrument, self.units, suppress = True, ret = True)
-                self.report_trade(order, "GOING LONG")
-            elif self.position == -1:
-                order = self.create_order(self.instrument, self.units * 2, suppress = True, ret = True) 
-                self.report_trade(order, "GOING LONG")
-            self.position = 1
-        elif self.data["position"].iloc[-1] == -1: 
-            if self.position == 0:
-                order = self.create_order(self.instrument, -self.units, suppress = True, ret = True)
-                self.report_trade(order, "GOING SHORT")
-            elif self.position == 1:
-                order = self.create_order(self.instrument, -self.units * 2, suppress = True, ret = True)
-                self.report_trade(order, "GOING SHORT")
-            self.position = -1
-        elif self.data["position"].iloc[-1] == 0: 
-            if self.position == -1:
-                order = self.create_order(self.instrument, self.units, suppress = True, ret = True) 
-                self.report_trade(order, "GOING NEUTRAL")
-            elif self.position == 1:
-                order = self.create_order(self.instrument, -self.units, suppress = True, ret = True)
-                self.report_trade(order, "GOING NEUTRAL")
-            self.position = 0
+        with self.metrics.timer("execute_trades"):
+            self._execute_trades()
+        if self.snapshot is not None: # stores the units filled so far, not the position just asked for
+            with self.metrics.timer("snapshot"):
+                # every snapshot_every bars, and on the first bar after a fill
+                filled = self.order_manager.position
+                self.snapshot.maybe_save(*self.snapshot_state(), force = filled != self._snapshot_filled)
+                self._snapshot_filled = filled
+    
+    def _execute_trades(self):
+        # the wanted position goes to the order manager, which sends what the filled and
+        # pending orders are short of it (a reversal is one order of 2 * units)
+        position = self.data["position"].iloc[-1]
+        if position in (1, -1, 0):
+            going = {1: "GOING LONG", -1: "GOING SHORT", 0: "GOING NEUTRAL"}[position]
+            self.order_manager.target(int(position) * self.units, going, self.tick_clock)
+            self.position = int(position)
+    
+    def order_filled(self, order):
+        self.report_trade(order.fill, order.going, order.clock)
             
     def date_convert(self,date_str):
         x = date_str.replace('T','/').split('/')
@@ -159,19 +269,21 @@ class DNNTrader2(tpqoa.tpqoa):
         return new_date
     
     def SQL_DB(self,time, units, price, pl, cumpl):
-        trade_id = uuid.uuid4()
-        time_fin = self.date_convert(str(time))
-        self.mydb = pymysql.connect(host="localhost",user="root",passwd="password")
-        self.mycursor = self.mydb.cursor()
-        self.mycursor.execute("CREATE DATABASE IF NOT EXISTS TradesDB")
-        self.mycursor.execute('USE TradesDB')
-        self.mycursor.execute(f'CREATE TABLE IF NOT EXISTS TradesTable_DNN_{self.instrument} (TradeID CHAR(40) NOT NULL PRIMARY KEY,time DATETIME,Instrument CHAR(40), Units INT(20),Price FLOAT(10),pnl FLOAT(10),CumPnL FLOAT(10))')                                                               
-        sql1 = f"INSERT INTO TradesTable_DNN_{self.instrument} (TradeID,time,Instrument,Units,Price,pnl,CumPnL) VALUES (%s,%s,%s,%s,%s,%s,%s)"
-        trade = (trade_id, time_fin, self.instrument, units, price, pl, cumpl)
-        self.mycursor.execute(sql1,trade)
-        self.mydb.commit()
-    
-    def report_trade(self, order, going):
+        # queued for the background journal writer, never blocks the order path
+        self.journal.record(self.instrument, self.date_convert(str(time)), units, price, pl, cumpl)
+    
+    def create_order(self, *args, **kwargs):
+        with self.metrics.timer("create_order"): # broker round trip
+            return super().create_order(*args, **kwargs)
+    
+    def report_trade(self, order, going, clock = None):
+        clock = self.tick_clock if clock is None else clock
+        if clock is not None:
+            self.metrics.observe("tick_to_order", perf_counter() - clock)
+        with self.metrics.timer("report_trade"):
+            self._report_trade(order, going)
+    
+    def _report_trade(self, order, going):
         time = order["time"]
         units = order["units"]
         price = order["price"]
@@ -189,9 +301,10 @@ class DNNTrader2(tpqoa.tpqoa):
 
 if __name__ == "__main__":
 
-    DNN = keras.models.load_model('DNN_model_3')
-    LR = pickle.load(open('Logistic_Regression_model2.sav', "rb"))
-    RF = pickle.load(open('Random_Forest_3.sav', "rb"))
+    # exported .tflite / .npz artifacts (python models.py) are used when present
+    DNN = exported('DNN_model_3', ".tflite")
+    LR = exported('Logistic_Regression_model2.sav', ".npz")
+    RF = exported('Random_Forest_3.sav', ".npz")
     params = pickle.load(open("params.pkl", "rb"))
     mu = params['mu']
     std = params['std']
@@ -202,15 +315,22 @@ if __name__ == "__main__":
     
     trader = DNNTrader2("oanda.cfg", "EUR_USD", bar_length = "1min",
                        window = 50, lags = 5, LR_model = LR, DNN_model = DNN, RF_model = RF, mu = mu, std = std, 
-                        units = 100000, Comb_Str = 2)
+                        units = 100000, Comb_Str = 2, metrics_port = 8001,
+                        snapshot = "state_DNN_EUR_USD.npz", retrain_every = 1440)
+    trader.metrics.profile_on_signal("profile_DNN_EUR_USD.txt") # kill -USR2 <pid> to start / stop
     
     trader.get_most_recent()
-    trader.stream_data(trader.instrument, stop = 1000)
-    if trader.position != 0:
-        close_order = trader.create_order(trader.instrument, units = -trader.position * trader.units,
-                                          suppress = True, ret = True) 
-        trader.report_trade(close_order, "GOING NEUTRAL")
-        trader.position = 0
+    BarPipeline(trader).stream(stop = 1000) # signals are computed off the tick thread
+    trader.order_manager.target(0, "GOING NEUTRAL") # close out, then wait for the pending orders
+    trader.order_manager.close()
+    trader.position = 0
+    if trader.snapshot is not None:
+        trader.snapshot.save(*trader.snapshot_state())
+    trader.journal.close()
+    if trader.retrainer is not None:
+        trader.retrainer.close()
+    trader.metrics.report()
+    trader.metrics.close()
 
 
 # In[ ]:
@@ -1,26 +1,52 @@
+import os
 import pandas as pd
 import numpy as np
 import tpqoa
 from datetime import datetime, timedelta
 import time
-import pickle
-import pymysql
-import uuid
-from statsmodels.tsa.arima.model import ARIMA
+from time import perf_counter
+from buffers import TickBuffer, FrameBuffer
+from bars import BarBuilder
+from history_cache import HistoryCache
+from journal import TradeJournal, MySQLBackend
+from indicators import ConIndicators
+from arima import ArimaSignal
+from inference import lag_matrix, EnsembleScorer
+from pipeline import BarPipeline
+from metrics import Metrics
+from models import LazyModel, exported
+from snapshot import Snapshot
+from orders import OrderManager, TraderBroker
+from retrain import Retrainer, fit_direction, portable
 
 class ConTrader(tpqoa.tpqoa):
-    def __init__(self, conf_file, instrument, bar_length, window, units, lags, model,p,ind,q,SMA_S,SMA_L,SMA_Bol,Dev,Comb_Str=1)         :
+    def __init__(self, conf_file, instrument, bar_length, window, units, lags, model,p,ind,q,SMA_S,SMA_L,SMA_Bol,Dev,Comb_Str=1, max_bars = 10000, cache_dir = "history", journal_backend = None, arima_refit = 60, arima_window = None, arima_background = True, metrics_port = None, metrics_file = None, snapshot = None, snapshot_every = 5, snapshot_background = True, retrain_every = None, retrain_window = None, retrain_background = True, broker = None, order_timeout = 10, order_retries = 3, order_background = True, frame_dtype = np.float32):
         super().__init__(conf_file)
         self.instrument = instrument
         self.Comb_Str = Comb_Str
         self.bar_length = pd.to_timedelta(bar_length)
-        self.tick_data = pd.DataFrame()
+        self.tick_data = TickBuffer()
+        self.bars = BarBuilder(bar_length, capacity = max_bars)
+        self.cache = HistoryCache(cache_dir) # local candle store, only the missing tail is downloaded
         self.raw_data = None
         self.data = None 
         self.last_bar = None
         self.units = units
         self.position = 0
         self.profits = []
+        self.journal = TradeJournal(journal_backend or MySQLBackend(), "TradesTable_{}".format(instrument))
+        self.metrics = Metrics({"instrument": instrument}) # per-stage latencies (p50/p99), Prometheus export
+        if metrics_port is not None:
+            self.metrics.serve(metrics_port)
+        if metrics_file is not None:
+            self.metrics.export(metrics_file)
+        self.tick_clock = None # arrival of the tick being handled, for the tick-to-order latency
+        self.snapshot = Snapshot(snapshot, snapshot_every, snapshot_background) if snapshot else None # crash-safe state file
+        self._snapshot_filled = 0 # filled units in the last snapshot
+        # orders leave from a background thread (broker: create_order of this class unless given)
+        self.order_manager = OrderManager(broker or TraderBroker(self), instrument, timeout = order_timeout,
+                                          retries = order_retries, on_fill = self.order_filled, metrics = self.metrics,
+                                          background = order_background)
 
         #*****************add strategy-specific attributes here******************
         self.window = window
@@ -28,129 +54,212 @@ class ConTrader(tpqoa.tpqoa):
         self.ind = ind
         self.q = q
         self.lags = lags
-        self.model = pickle.load(open(model, "rb"))
+        self.model = LazyModel(model) # loads in the background while get_most_recent downloads
         self.SMA_S = SMA_S
         self.SMA_L = SMA_L
         self.SMA_Bol = SMA_Bol
         self.Dev = Dev
+        self.indicators = ConIndicators(window, SMA_S, SMA_L, SMA_Bol, Dev, capacity = max_bars)
+        self.ml_cols = ["lag{}".format(lag) for lag in range(1, lags + 1)]
+        self.ml_scorer = EnsembleScorer(self.ml_cols, {"ML_position": lambda X: self.model.predict(X)})
+        self.ml_data = FrameBuffer(max_bars, ["ML_position"])
+        self.arima = ArimaSignal((p, ind, q), refit_every = arima_refit, fit_window = arima_window,
+                                  capacity = max_bars, background = arima_background)
+        # ML model refitted every retrain_every bars on the last retrain_window bars (off by default)
+        self.retrainer = Retrainer(fit_direction, every = retrain_every, background = retrain_background,
+                                   metrics = self.metrics, tag = instrument) if retrain_every else None
+        self.retrain_window = retrain_window or max_bars
+        # the combined strategy rows (self.data) of the last bars, as long as the longest lookback
+        self.signal_cols = [instrument, "Contrarian_returns", "Contrarian_position", "ML_position"] + ArimaSignal.COLUMNS + \
+                           ["SMA_S", "SMA_L", "SMA_position", "SMA_Bol", "Lower_Bol", "Upper_Bol", "distance", "Bol_position", "position"]
+        self.signals = FrameBuffer(max(window, SMA_S, SMA_L, SMA_Bol, lags) + 1, self.signal_cols, dtype = frame_dtype)
         #************************************************************************
     
+    def utcnow(self): # wall clock; replay.py runs the trader on the clock of the replayed ticks
+        return datetime.utcnow()
+    
     def get_most_recent(self, days = 5):
+        resumed = self.restore_snapshot(days)
         while True:
             time.sleep(2)
-            now = datetime.utcnow()
+            now = self.utcnow()
             now = now - timedelta(microseconds = now.microsecond)
             past = now - timedelta(days = days)
-            df = self.get_history(instrument = self.instrument, start = past, end = now,
-                                   granularity = "S5", price = "M", localize = False).c.dropna().to_frame()
+            if resumed: # only the bars missed since the snapshot
+                past = (self.last_bar - self.bar_length).tz_localize(None).to_pydatetime()
+            df = self.cache.get_history(self, instrument = self.instrument, start = past, end = now,
+                                        granularity = "S5", price = "M").c.dropna().to_frame()
             df.rename(columns = {"c":self.instrument}, inplace = True)
-            df = df.resample(self.bar_length, label = "right").last().dropna().iloc[:-1]
-            self.raw_data = df.copy()
-            self.last_bar = self.raw_data.index[-1]
-            if pd.to_datetime(datetime.utcnow()).tz_localize("UTC") - self.last_bar < self.bar_length:
+            if resumed:
+                self.bars.backfill(df[self.instrument])
+            else:
+                self.bars.load(df[self.instrument])
+            self.raw_data = self.bars.frame(self.instrument)
+            self.last_bar = self.bars.last_time()
+            if pd.to_datetime(self.utcnow()).tz_localize("UTC") - self.last_bar < self.bar_length:
                 break
+        self.predict_ml(self.indicators.sync(self.bars.history)) # warm up the incremental indicators
+        self.arima.sync(self.bars.history) # initial ARIMA fit (after a restart: only the missed bars)
+        self.combine(self.signals.capacity)
+    
+    def snapshot_state(self):
+        # only the rows a restore reads: the rolling windows, the ARIMA fit window, the lags
+        # and the retraining window, and the rows combine() needs for the signals ring
+        rows = self.signals.capacity
+        returns = max(rows, self.lags + 1, self.retrain_window if self.retrainer is not None else 0)
+        buffers = {"bars": (self.bars.history, max(rows, self.indicators.warmup, self.arima.fit_window)),
+                   "indicators": (self.indicators.history, returns),
+                   "ml": (self.ml_data, rows), "arima": (self.arima.history, rows)}
+        meta = {"instrument": self.instrument, "bar_length": str(self.bar_length), "filled": self.order_manager.position,
+                "profits": self.profits, "arima": self.arima.state(),
+                "model": self.model.source if isinstance(self.model.source, str) else None}
+        return buffers, meta
+    
+    def restore_snapshot(self, days = 5):
+        # resume bars, indicators, ARIMA, position and P&L from the snapshot of this
+        # instrument if it is less than `days` old; False means a full warm-up is needed
+        state = self.snapshot.load() if self.snapshot is not None else None
+        if state is None:
+            return False
+        buffers, meta = state
+        last_bar = pd.Timestamp(int(buffers["bars"][0][-1]), tz = "UTC")
+        if (meta["instrument"], meta["bar_length"]) != (self.instrument, str(self.bar_length)) \
+                or pd.Timestamp(self.utcnow(), tz = "UTC") - last_bar > pd.Timedelta(days = days):
+            return False
+        self.bars.history.load(*buffers["bars"])
+        self.indicators.restore(*buffers["indicators"], self.bars.history)
+        self.ml_data.load(*buffers["ml"])
+        self.arima.restore(*buffers["arima"], self.bars.history, **meta["arima"])
+        self.order_manager.position = meta["filled"] # held at the broker already, pending orders are sent again
+        self.position = int(np.sign(meta["filled"]))
+        self.profits = meta["profits"]
+        if meta.get("model") and meta["model"] != self.model.source and os.path.exists(meta["model"]):
+            self.model = LazyModel(meta["model"]) # a retrained model
+        self.last_bar = last_bar
+        print("Resumed from {} | last bar = {} | position = {} | Cum P&L = {}".format(
+            self.snapshot.path, last_bar, self.position, sum(self.profits)))
+        return True
                 
     def on_success(self, time, bid, ask):
+        self.tick_clock = perf_counter()
         print(self.ticks, end = " ", flush = True)
         
         recent_tick = pd.to_datetime(time)
-        df = pd.DataFrame({self.instrument:(ask + bid)/2}, 
-                          index = [recent_tick])
-        self.tick_data = self.tick_data.append(df)
+        price = (ask + bid)/2
+        self.tick_data.append(recent_tick, price)
         
-        if recent_tick - self.last_bar > self.bar_length:
+        if self.bars.update(recent_tick, price): # a bar has just been completed
             self.resample_and_join()
             self.define_strategy()
             self.execute_trades()
-            #self.model_train(1,1,0)
+        self.metrics.observe("on_success", perf_counter() - self.tick_clock)
     
     def resample_and_join(self):
-        self.raw_data = self.raw_data.append(self.tick_data.resample(self.bar_length, 
-                                                                  label="right").last().ffill().iloc[:-1])
-        self.tick_data = self.tick_data.iloc[-1:]
-        self.last_bar = self.raw_data.index[-1]
+        with self.metrics.timer("resample_and_join"):
+            self.raw_data = self.bars.frame(self.instrument) # bounded view of the finished bars
+            self.tick_data.keep_last()
+            self.last_bar = self.bars.last_time()
         
             
     def define_strategy(self): # "strategy-specific"
-        df = self.raw_data.copy()
+        with self.metrics.timer("define_strategy"):
+            self._define_strategy()
+    
+    def _define_strategy(self):
+        timer = self.metrics.timer
+        with timer("indicators"): # Contrarian, SMA and Bollinger are updated in one pass
+            new_bars = self.indicators.sync(self.bars.history) # O(1) update per new bar
+        if new_bars:
+            for stage, seconds in self.indicators.timings.items():
+                self.metrics.observe(stage, seconds)
         
-        #******************** Contrarian_Strategy*******************************
+        #*************************** ML_Strategy *******************************
+        with timer("ML"):
+            self.swap_models() # between two bars, never in the middle of one
+            self.predict_ml(new_bars)
+            if self.retrainer is not None:
+                self.retrainer.update(new_bars, self.retrain_data)
         
-        df["Contrarian_returns"] = np.log(df[self.instrument] / df[self.instrument].shift())
-        df["Contrarian_position"] = -np.sign(df['Contrarian_returns'].rolling(self.window).mean())
+        #***************************** ARIMA Strategy ***************************
+        with timer("ARIMA"):
+            self.arima.sync(self.bars.history) # filtered bar by bar, refitted in the background
         
-        #*************************** ML_Strategy *******************************
+        with timer("combine"):
+            self.combine(new_bars)
+    
+    def combine(self, rows):
+        # The strategy columns of the newest `rows` bars side by side and the combined
+        # position. Only complete rows are kept (the dropna of the full-history join), in a
+        # ring of the last bars: nothing grows with the session. self.data is a copy of the
+        # ring (a few hundred rows), so a frame kept from an earlier bar stays as it was.
+        times = self.bars.history.times.view(rows)
+        cols = {self.instrument: self.bars.history.column("c", rows).astype(float)}
         
-        df = df.append(self.tick_data) # append latest tick (== open price of current bar)
-        df["ML_returns"] = np.log(df[self.instrument] / df[self.instrument].shift())
-        cols = []
-        for lag in range(1, self.lags + 1):
-            col = "lag{}".format(lag)
-            df[col] = df['ML_returns'].shift(lag)
-            cols.append(col)
-        df.dropna(inplace = True)
-        df["ML_position"] = self.model.predict(df[cols])
+        #******************** Contrarian_Strategy*******************************
+        cols.update(self.indicators.history.at(times, ["Contrarian_returns", "Contrarian_position"]))
         
-        #***************************** ARIMA Strategy ***************************
+        #*************************** ML_Strategy *******************************
+        cols.update(self.ml_data.at(times))
         
-        ARIMA_model = ARIMA(df[self.instrument], order=(self.p,self.ind,self.q))
-        model_fit = ARIMA_model.fit()
-        df['ARIMA_forecast'] = model_fit.predict()
-        df['ARIMA_returns'] = df['ARIMA_forecast'] - df[self.instrument].shift(1)
-        df.dropna(inplace=True)
-        df["ARIMA_position"] = np.sign(df['ARIMA_returns'])
+        #***************************** ARIMA Strategy ***************************
+        cols.update(self.arima.history.at(times))
         
         #****************************** SMA Strategy ***************************
-        df["SMA_S"] = df[self.instrument].rolling(self.SMA_S).mean()
-        df["SMA_L"] = df[self.instrument].rolling(self.SMA_L).mean()
-        df.dropna(inplace=True)
-        df["SMA_position"] = np.where(df["SMA_S"] > df["SMA_L"], 1.0, -1.0)
+        cols.update(self.indicators.history.at(times, ["SMA_S", "SMA_L", "SMA_position"]))
         
         #****************************** Bollinger ******************************
-        df["SMA_Bol"] = df[self.instrument].rolling(self.SMA_Bol).mean()
-        df["Lower_Bol"] = df["SMA_Bol"] - df[self.instrument].rolling(self.SMA_Bol).std() * self.Dev
-        df["Upper_Bol"] = df["SMA_Bol"] + df[self.instrument].rolling(self.SMA_Bol).std() * self.Dev
-        df.dropna(inplace=True)
-        df["distance"] = df[self.instrument] - df['SMA_Bol']
-        df["Bol_position"] = np.where(df[self.instrument] < df.Lower_Bol, 1, np.nan)
-        df["Bol_position"] = np.where(df[self.instrument] > df.Upper_Bol, -1, df["Bol_position"])
-        df["Bol_position"] = np.where(df.distance * df.distance.shift(1) < 0, 0, df["Bol_position"])
-        df["Bol_position"] = df.Bol_position.ffill().fillna(0)
+        cols.update(self.indicators.history.at(times, ["SMA_Bol", "Lower_Bol", "Upper_Bol", "distance", "Bol_position"]))
         
         #***********************************************************************
         #Unanimous Trade Strategy
         if self.Comb_Str == 1:
-            df['position'] = np.where((df['ARIMA_position']==df['ML_position']) & (df['ML_position']==df['Contrarian_returns']) & (df['Contrarian_returns'] == df['SMA_position']),df['ML_position'],0)                          
+            cols['position'] = np.where((cols['ARIMA_position']==cols['ML_position']) & (cols['ML_position']==cols['Contrarian_returns']) & (cols['Contrarian_returns'] == cols['SMA_position']),cols['ML_position'],0)
         elif self.Comb_Str == 2:
-            df['position'] = np.sign(df['Bol_position']+ df['ARIMA_position'] + df['ML_position'] + df['Contrarian_returns'] + df['SMA_position'])      
+            cols['position'] = np.sign(cols['Bol_position']+ cols['ARIMA_position'] + cols['ML_position'] + cols['Contrarian_returns'] + cols['SMA_position'])
         
-        self.data = df.copy()
+        complete = ~np.isnan(np.column_stack([cols[col] for col in self.signal_cols])).any(axis = 1)
+        self.signals.extend(pd.to_datetime(times[complete], utc = True), {col: val[complete] for col, val in cols.items()})
+        self.data = self.signals.frame().copy()
+    
+    def predict_ml(self, rows):
+        # score the newest bars from a strided lag matrix of the bar returns, in one call
+        returns = self.indicators.history.column("Contrarian_returns")
+        X = lag_matrix([returns], self.lags, rows = rows)
+        if len(X):
+            self.ml_data.extend(self.indicators.history.index(len(X)), self.ml_scorer.predict(X))
+    
+    def retrain_data(self):
+        # training window of the background refit, copied since the buffers keep moving
+        returns = self.indicators.history.column("Contrarian_returns")[-self.retrain_window:]
+        return {"returns": returns.copy(), "cols": self.ml_cols, "current": {"model": portable(self.model)}}
+    
+    def swap_models(self):
+        swap = self.retrainer.poll() if self.retrainer is not None else None
+        if swap is not None:
+            models, params = swap
+            self.model = models["model"] # ml_scorer calls self.model, the next bar uses the new one
     
     def execute_trades(self):
-        if self.data["position"].iloc[-1] == 1:
-            if self.position == 0:
-                order = self.create_order(self.instrument, self.units, suppress = True, ret = True)
-                self.report_trade(order, "GOING LONG")
-            elif self.position == -1:
-                order = self.create_order(self.instrument, self.units * 2, suppress = True, ret = True) 
-                self.report_trade(order, "GOING LONG")
-            self.position = 1
-        elif self.data["position"].iloc[-1] == -1: 
-            if self.position == 0:
-                order = self.create_order(self.instrument, -self.units, suppress = True, ret = True)
-                self.report_trade(order, "GOING SHORT")
-            elif self.position == 1:
-                order = self.create_order(self.instrument, -self.units * 2, suppress = True, ret = True)
-                self.report_trade(order, "GOING SHORT")
-            self.position = -1
-        elif self.data["position"].iloc[-1] == 0:
-            if self.position == -1:
-                order = self.create_order(self.instrument, self.units, suppress = True, ret = True) 
-                self.report_trade(order, "GOING NEUTRAL")
-            elif self.position == 1:
-                order = self.create_order(self.instrument, -self.units, suppress = True, ret = True) 
-                self.report_trade(order, "GOING NEUTRAL")
-            self.position = 0
+        with self.metrics.timer("execute_trades"):
+            self._execute_trades()
+        if self.snapshot is not None: # stores the units filled so far, not the position just asked for
+            with self.metrics.timer("snapshot"):
+                # every snapshot_every bars, and on the first bar after a fill
+                filled = self.order_manager.position
+                self.snapshot.maybe_save(*self.snapshot_state(), force = filled != self._snapshot_filled)
+                self._snapshot_filled = filled
+    
+    def _execute_trades(self):
+        # the wanted position goes to the order manager, which sends what the filled and
+        # pending orders are short of it (a reversal is one order of 2 * units)
+        position = self.data["position"].iloc[-1]
+        if position in (1, -1, 0):
+            going = {1: "GOING LONG", -1: "GOING SHORT", 0: "GOING NEUTRAL"}[position]
+            self.order_manager.target(int(position) * self.units, going, self.tick_clock)
+            self.position = int(position)
+    
+    def order_filled(self, order):
+        self.report_trade(order.fill, order.going, order.clock)
             
     def date_convert(self,date_str):
         x = date_str.replace('T','/').split('/')
@@ -165,20 +274,21 @@ class ConTrader(tpqoa.tpqoa):
         return new_date
     
     def SQL_DB(self,time, units, price, pl, cumpl):
-        trade_id = uuid.uuid4()
-        time_fin = self.date_convert(str(time))
-        self.mydb = pymysql.connect(host="localhost",user="root",passwd="password")
-        self.mycursor = self.mydb.cursor()
-        self.mycursor.execute("CREATE DATABASE IF NOT EXISTS TradesDB")
-        self.mycursor.execute('USE TradesDB')
-        self.mycursor.execute(f'CREATE TABLE IF NOT EXISTS TradesTable_{self.instrument} (TradeID CHAR(40) NOT NULL PRIMARY KEY,time DATETIME,Instrument CHAR(40), Units INT(20),Price FLOAT(10),pnl FLOAT(10),CumPnL FLOAT(10))')                                                               
-        sql1 = f"INSERT INTO TradesTable_{self.instrument} (TradeID,time,Instrument,Units,Price,pnl,CumPnL) VALUES (%s,%s,%s,%s,%s,%s,%s)"
-        trade = (trade_id, time_fin, self.instrument, units, price, pl, cumpl)
-        self.mycursor.execute(sql1,trade)
-        self.mydb.commit()
-        
-        
-    def report_trade(self, order, going):
+        # queued for the background journal writer, never blocks the order path
+        self.journal.record(self.instrument, self.date_convert(str(time)), units, price, pl, cumpl)
+    
+    def create_order(self, *args, **kwargs):
+        with self.metrics.timer("create_order"): # broker round trip
+            return super().create_order(*args, **kwargs)
+    
+    def report_trade(self, order, going, clock = None):
+        clock = self.tick_clock if clock is None else clock
+        if clock is not None:
+            self.metrics.observe("tick_to_order", perf_counter() - clock)
+        with self.metrics.timer("report_trade"):
+            self._report_trade(order, going)
+    
+    def _report_trade(self, order, going):
         time = order["time"]
         units = order["units"]
         price = order["price"]
@@ -198,16 +308,24 @@ class ConTrader(tpqoa.tpqoa):
 if __name__ == "__main__":
     
     trader = ConTrader("oanda.cfg", "EUR_USD", "1min", window = 1,
-                       units = 100000, lags = 5, model = 'logreg.pkl',
+                       units = 100000, lags = 5, model = exported('logreg.pkl', ".npz"),
                        p = 1, ind = 1,q = 0, SMA_S = 50,SMA_L = 200 ,
-                       SMA_Bol=20,Dev=1,Comb_Str=2)                 
+                       SMA_Bol=20,Dev=1,Comb_Str=2, metrics_port = 8000,
+                       snapshot = "state_EUR_USD.npz", retrain_every = 1440)                 
+    trader.metrics.profile_on_signal("profile_EUR_USD.txt") # kill -USR2 <pid> to start / stop
     trader.get_most_recent()
-    trader.stream_data(trader.instrument, stop = None)
-    if trader.position != 0: 
-        close_order = trader.create_order(trader.instrument, units = -trader.position * trader.units, 
-                                              suppress = True, ret = True) 
-        trader.report_trade(close_order, "GOING NEUTRAL")
-        trader.position = 0
+    BarPipeline(trader).stream(stop = None) # signals are computed off the tick thread
+    trader.order_manager.target(0, "GOING NEUTRAL") # close out, then wait for the pending orders
+    trader.order_manager.close()
+    trader.position = 0
+    if trader.snapshot is not None:
+        trader.snapshot.save(*trader.snapshot_state())
+    trader.journal.close()
+    trader.arima.close()
+    if trader.retrainer is not None:
+        trader.retrainer.close()
+    trader.metrics.report()
+    trader.metrics.close()
 
 
 # In[ ]:
@@ -0,0 +1,128 @@
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+import numpy as np
+from statsmodels.tsa.arima.model import ARIMA
+from indicators import IndicatorEngine
+
+
+class ArimaSignal(IndicatorEngine):
+    # ARIMA strategy of ConTrader without refitting on every bar.
+    # The fitted state space results are kept between bars: each new bar is run through
+    # the Kalman filter with results.extend() (parameters unchanged, O(1) in the history
+    # length), and a full refit on the last fit_window bars runs every refit_every bars
+    # on a background thread. The refitted results are brought up to date with the bars
+    # that arrived while fitting and swapped in on the next update. With background = False
+    # the refit runs in the foreground instead, so replays give the same signals every run.
+    COLUMNS = ["ARIMA_forecast", "ARIMA_returns", "ARIMA_position"]
+
+    def __init__(self, order, refit_every = 60, fit_window = None, capacity = 10000, background = True):
+        super().__init__(capacity)
+        self.order = tuple(order)
+        self.refit_every = refit_every
+        self.fit_window = fit_window or capacity
+        self.background = background
+        self.results = None
+        self.latencies = deque(maxlen = 1000) # seconds per bar update
+        self.last_fit_seconds = None
+        self._window = deque(maxlen = self.fit_window) # observations for the next refit
+        self._since_refit = []
+        self._bars_since_fit = 0
+        self._prev_price = None
+        self._refit = None
+        self._executor = ThreadPoolExecutor(max_workers = 1)
+
+    def _fit(self, y):
+        # a cold fit: starting from the previous parameters leaves the optimizer stuck there
+        # on minute FX prices (sigma2 is ~1e-9), so only the filter state is carried over
+        t0 = time.perf_counter()
+        results = ARIMA(np.asarray(y, dtype = float), order = self.order).fit()
+        return results, time.perf_counter() - t0
+
+    def sync(self, bars, column = "c"):
+        if self.results is None and len(bars):
+            # initial fit in the foreground: in-sample one-step predictions fill the history
+            y = bars.column(column)[-self.fit_window:]
+            self.results, self.last_fit_seconds = self._fit(y)
+            forecast = self.results.fittedvalues
+            returns = forecast[1:] - y[:-1]
+            self.history.extend(bars.index(len(y)), {"ARIMA_forecast": forecast,
+                                                     "ARIMA_returns": np.r_[np.nan, returns],
+                                                     "ARIMA_position": np.r_[np.nan, np.sign(returns)]})
+            self._window.extend(y)
+            self._prev_price = float(y[-1])
+            self.last_time = int(bars.times.last())
+            return len(y)
+        return super().sync(bars, column)
+
+    def state(self):
+        # what a Snapshot needs besides the bars and the output history
+        return {"params": [float(p) for p in self.results.params], "bars_since_fit": self._bars_since_fit}
+
+    def restore(self, times, values, bars, params, bars_since_fit = 0, column = "c"):
+        # Continue from a Snapshot without a refit: the stored parameters are run through
+        # the Kalman filter over the last fit_window bars up to the stored last bar.
+        self.history.load(times, values)
+        self.last_time = int(times[-1])
+        end = np.searchsorted(bars.times.view(), self.last_time, side = "right")
+        y = bars.column(column)[:end][-self.fit_window:]
+        self.results = ARIMA(np.asarray(y, dtype = float), order = self.order).filter(np.asarray(params))
+        self._window.clear()
+        self._window.extend(y)
+        self._prev_price = float(y[-1])
+        self._bars_since_fit = bars_since_fit
+
+    def update(self, price):
+        t0 = time.perf_counter()
+        self._swap_refit()
+        forecast = float(self.results.forecast(1)[0]) # prediction of this bar from the bars before it
+        self.results = self.results.extend([price])
+        self._window.append(price)
+        if self._refit is not None:
+            self._since_refit.append(price)
+        returns = forecast - self._prev_price
+        self._prev_price = price
+        self._bars_since_fit += 1
+        if self.refit_every and self._bars_since_fit >= self.refit_every and self._refit is None:
+            self._bars_since_fit = 0
+            self._since_refit = []
+            if self.background:
+                self._refit = self._executor.submit(self._fit, list(self._window))
+            else:
+                self._refit = Future()
+                self._refit.set_result(self._fit(list(self._window)))
+        self.latencies.append(time.perf_counter() - t0)
+        return {"ARIMA_forecast": forecast, "ARIMA_returns": returns, "ARIMA_position": np.sign(returns)}
+
+    def _swap_refit(self):
+        if self._refit is None or not self._refit.done():
+            return
+        future, self._refit = self._refit, None
+        try:
+            results, self.last_fit_seconds = future.result()
+        except Exception as e: # keep filtering with the old parameters
+            print("ARIMA refit failed: {}".format(e))
+            return
+        if self._since_refit:
+            results = results.extend(self._since_refit)
+        self.results = results
+        self._since_refit = []
+        print("\n" + self.report())
+
+    def latency(self):
+        lat = np.array(self.latencies) * 1000
+        if len(lat) == 0:
+            return {}
+        return {"bars": len(lat), "mean_ms": lat.mean(), "p50_ms": np.percentile(lat, 50),
+                "p99_ms": np.percentile(lat, 99), "max_ms": lat.max()}
+
+    def report(self):
+        stats = self.latency()
+        line = "ARIMA{} | last refit = {:.2f}s".format(self.order, self.last_fit_seconds or 0)
+        if stats:
+            line += " | per-bar update p50 = {:.2f}ms | p99 = {:.2f}ms | max = {:.2f}ms".format(
+                stats["p50_ms"], stats["p99_ms"], stats["max_ms"])
+        return line
+
+    def close(self):
+        self._executor.shutdown(wait = False)
@@ -0,0 +1,196 @@
+import itertools
+import numpy as np
+import pandas as pd
+from statsmodels.tsa.arima.model import ARIMA
+from inference import lag_matrix, EnsembleScorer
+from models import load_model
+
+
+class Backtester:
+    # Vectorized offline replay of a trader: the signals of define_strategy are computed
+    # for every bar in one pass, and the positions follow execute_trades (the position
+    # after a bar is that bar's signal, held until the next bar closes).
+    # units and tc (cost per unit traded, in price terms, e.g. half the spread) give the
+    # P&L in quote currency, comparable to the "pl" OANDA reports per trade.
+    # prices are candle closes indexed by candle start time as get_history returns them
+    # (S5 or M1), and are binned into bars exactly like get_most_recent does.
+    defaults = {}
+
+    def __init__(self, prices, bar_length = "1min", units = 100000, tc = 0.0, **params):
+        if isinstance(prices, pd.DataFrame):
+            prices = prices["c"]
+        self.bar_length = pd.to_timedelta(bar_length)
+        self.price = prices.resample(self.bar_length, label = "right").last().dropna()
+        self.units = units
+        self.tc = tc
+        self.params = {**self.defaults, **params}
+        self._cache = {}
+
+    def _cached(self, key, func):
+        if key not in self._cache:
+            self._cache[key] = func()
+        return self._cache[key]
+
+    def signals(self, **params):
+        raise NotImplementedError
+
+    def run(self, **params):
+        params = {**self.params, **params}
+        df = self.signals(**params)
+        df["position"] = df["position"].ffill().fillna(0)
+        df["trade_units"] = df["position"].diff().fillna(df["position"]) * self.units
+        df["trades"] = (df["trade_units"] != 0).astype(int)
+        held = df["position"].shift().fillna(0)
+        df["returns"] = np.log(df["price"] / df["price"].shift()).fillna(0)
+        df["costs"] = df["trade_units"].abs() * self.tc
+        df["pnl"] = held * self.units * df["price"].diff().fillna(0) - df["costs"]
+        df["cum_pnl"] = df["pnl"].cumsum()
+        df["strategy"] = held * df["returns"] - df["trade_units"].abs() / self.units * self.tc / df["price"]
+        return df, self.summary(df, params)
+
+    def summary(self, df, params):
+        years = (df.index[-1] - df.index[0]) / pd.Timedelta(days = 365.25)
+        bars_per_year = len(df) / years if years > 0 else np.nan
+        std = df["strategy"].std()
+        sharpe = df["strategy"].mean() / std * np.sqrt(bars_per_year) if std > 0 else np.nan
+        drawdown = (df["cum_pnl"].cummax() - df["cum_pnl"]).max()
+        return {**params, "bars": len(df), "trades": int(df["trades"].sum()),
+                "costs": df["costs"].sum(), "pnl": df["pnl"].sum(),
+                "return": np.exp(df["strategy"].sum()) - 1, "sharpe": sharpe, "max_drawdown": drawdown}
+
+    def grid(self, **param_lists):
+        # run every combination, e.g. grid(Comb_Str = [1, 2], SMA_S = [20, 50]); component
+        # signals are cached, so only the combinations that change them are recomputed
+        names = list(param_lists)
+        rows = [self.run(**dict(zip(names, values)))[1] for values in itertools.product(*param_lists.values())]
+        return pd.DataFrame(rows)
+
+
+class ConBacktester(Backtester):
+    # ConTrader.define_strategy over the whole history. ARIMA parameters are fitted once on
+    # the first arima_fit_bars bars and then applied to the full series (one-step in-sample
+    # predictions with fixed parameters), so later bars carry no look-ahead in the parameters.
+    defaults = dict(window = 1, lags = 5, p = 1, ind = 1, q = 0, SMA_S = 50, SMA_L = 200,
+                    SMA_Bol = 20, Dev = 1, Comb_Str = 1)
+
+    def __init__(self, prices, model, bar_length = "1min", units = 100000, tc = 0.0, arima_fit_bars = 10000, **params):
+        super().__init__(prices, bar_length, units, tc, **params)
+        self.model = load_model(model) if isinstance(model, str) else model
+        self.arima_fit_bars = arima_fit_bars
+        self.returns = np.log(self.price / self.price.shift())
+
+    def contrarian(self, window):
+        return self._cached(("contrarian", window),
+                            lambda: -np.sign(self.returns.rolling(window).mean()))
+
+    def ml(self, lags):
+        def compute():
+            X = lag_matrix([self.returns.values], lags, rows = len(self.returns))
+            cols = ["lag{}".format(lag) for lag in range(1, lags + 1)]
+            pred = EnsembleScorer(cols, {"ML_position": self.model.predict}).predict(X)["ML_position"]
+            return pd.Series(pred, index = self.price.index[-len(X):]).reindex(self.price.index)
+        return self._cached(("ml", lags), compute)
+
+    def arima(self, p, ind, q):
+        def compute():
+            y = self.price.values
+            fit = ARIMA(y[:self.arima_fit_bars], order = (p, ind, q)).fit()
+            forecast = fit.apply(y).fittedvalues
+            return pd.Series(np.sign(forecast - self.price.shift().values), index = self.price.index)
+        return self._cached(("arima", p, ind, q), compute)
+
+    def sma(self, SMA_S, SMA_L):
+        def compute():
+            s = self.price.rolling(SMA_S).mean()
+            l = self.price.rolling(SMA_L).mean()
+            return pd.Series(np.where(s > l, 1.0, -1.0), index = self.price.index).where(l.notna())
+        return self._cached(("sma", SMA_S, SMA_L), compute)
+
+    def bollinger(self, SMA_Bol, Dev):
+        def compute():
+            mean = self.price.rolling(SMA_Bol).mean()
+            std = self.price.rolling(SMA_Bol).std()
+            distance = self.price - mean
+            position = np.where(self.price < mean - std * Dev, 1, np.nan)
+            position = np.where(self.price > mean + std * Dev, -1, position)
+            position = np.where(distance * distance.shift(1) < 0, 0, position)
+            return pd.Series(position, index = self.price.index).ffill().fillna(0).where(mean.notna())
+        return self._cached(("bollinger", SMA_Bol, Dev), compute)
+
+    def signals(self, window, lags, p, ind, q, SMA_S, SMA_L, SMA_Bol, Dev, Comb_Str):
+        df = pd.DataFrame({"price": self.price, "Contrarian_returns": self.returns,
+                           "Contrarian_position": self.contrarian(window), "ML_position": self.ml(lags),
+                           "ARIMA_position": self.arima(p, ind, q), "SMA_position": self.sma(SMA_S, SMA_L),
+                           "Bol_position": self.bollinger(SMA_Bol, Dev)})
+        df = df.dropna()
+        # same combination as ConTrader, including its use of Contrarian_returns
+        if Comb_Str == 1:
+            df["position"] = np.where((df["ARIMA_position"] == df["ML_position"]) & (df["ML_position"] == df["Contrarian_returns"]) & (df["Contrarian_returns"] == df["SMA_position"]), df["ML_position"], 0)
+        elif Comb_Str == 2:
+            df["position"] = np.sign(df["Bol_position"] + df["ARIMA_position"] + df["ML_position"] + df["Contrarian_returns"] + df["SMA_position"])
+        return df
+
+
+class DNNBacktester(Backtester):
+    # DNNTrader2.define_strategy over the whole history. Live, the signal that sets the
+    # position for a bar is scored on the first tick after the previous bar closed, from the
+    # lags of the bars before it; here it is stored on that previous bar.
+    defaults = dict(window = 50, lags = 5, Comb_Str = 2)
+    features = ["dir", "sma", "boll", "min", "max", "mom", "vol"]
+
+    def __init__(self, prices, LR_model, DNN_model, RF_model, mu, std, bar_length = "1min",
+                 units = 100000, tc = 0.0, **params):
+        super().__init__(prices, bar_length, units, tc, **params)
+        self.LR_model = LR_model
+        self.DNN_model = DNN_model
+        self.RF_model = RF_model
+        self.mu = mu
+        self.std = std
+
+    def feature_frame(self, window):
+        def compute():
+            price = self.price
+            df = pd.DataFrame(index = price.index)
+            returns = np.log(price / price.shift())
+            df["dir"] = np.where(returns > 0, 1, -1)
+            df["sma"] = price.rolling(window).mean() - price.rolling(150).mean()
+            df["boll"] = (price - price.rolling(window).mean()) / price.rolling(window).std()
+            df["min"] = price.rolling(window).min() / price - 1
+            df["max"] = price.rolling(window).max() / price - 1
+            df["mom"] = returns.rolling(3).mean()
+            df["vol"] = returns.rolling(window).std()
+            return df
+        return self._cached(("features", window), compute)
+
+    def predictions(self, window, lags):
+        def compute():
+            features = self.feature_frame(window)
+            X = lag_matrix([features[f].values for f in self.features], lags, rows = len(features), next_row = True)
+            cols = ["{}_lag_{}".format(f, lag) for f in self.features for lag in range(1, lags + 1)]
+            scorer = EnsembleScorer(cols, {"proba": lambda X: self.DNN_model.predict(X, verbose = 0),
+                                           "LR_position": self.LR_model.predict,
+                                           "RF_position": self.RF_model.predict}, self.mu, self.std)
+            return pd.DataFrame(scorer.predict(X), index = features.index[-len(X):]).reindex(features.index)
+        return self._cached(("predictions", window, lags), compute)
+
+    def signals(self, window, lags, Comb_Str):
+        df = self.predictions(window, lags).dropna()
+        df.insert(0, "price", self.price)
+        df["DNN_position"] = np.where(df.proba < 0.50, -1, np.nan)
+        df["DNN_position"] = np.where(df.proba > 0.51, 1, df.DNN_position)
+        df["DNN_position"] = df.DNN_position.ffill().fillna(0)
+        if Comb_Str == 1:
+            df["position"] = np.where((df["LR_position"] == df["DNN_position"]) & (df["DNN_position"] == df["RF_position"]), df["DNN_position"], 0)
+        elif Comb_Str == 2:
+            df["position"] = np.sign(df["LR_position"] + df["DNN_position"] + df["RF_position"])
+        return df
+
+
+if __name__ == "__main__":
+    
+    from history_cache import HistoryCache
+    
+    # S5 candles written by the live traders (or downloaded once through HistoryCache.get_history)
+    prices = HistoryCache("history").read("EUR_USD", "S5")
+    tester = ConBacktester(prices, "logreg.pkl", bar_length = "1min", units = 100000, tc = 0.00007)
+    print(tester.grid(Comb_Str = [1, 2], SMA_S = [20, 50], SMA_L = [100, 200]))
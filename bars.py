@@ -0,0 +1,90 @@
+import numpy as np
+import pandas as pd
+from buffers import FrameBuffer
+
+
+class BarBuilder:
+    # Streaming OHLC aggregation. Bars use the same bins as
+    # resample(bar_length, label = "right"): a tick at t falls into [a, a + bar_length)
+    # and that bar is labelled a + bar_length. Bins are aligned to the epoch, which
+    # matches resample's default origin for any bar length that divides a day.
+    # Finished bars go into a fixed-length FrameBuffer, so memory stays flat however
+    # long the session runs.
+    COLUMNS = ["o", "h", "l", "c", "n"]
+
+    def __init__(self, bar_length, capacity = 10000):
+        self.bar_length = pd.to_timedelta(bar_length)
+        self._step = self.bar_length.value
+        self.history = FrameBuffer(capacity, self.COLUMNS)
+        self._label = None # right edge (ns) of the bar in progress
+        self._o = self._h = self._l = self._c = np.nan
+        self._n = 0
+
+    def __len__(self):
+        return len(self.history)
+
+    def _resample(self, prices):
+        # exactly like the warm-up: empty bins are dropped and the bar in progress is discarded
+        bars = prices.resample(self.bar_length, label = "right").agg(["first", "max", "min", "last", "count"])
+        return bars.dropna().iloc[:-1]
+
+    def _extend(self, bars):
+        self.history.extend(bars.index, {"o": bars["first"].values, "h": bars["max"].values,
+                                         "l": bars["min"].values, "c": bars["last"].values,
+                                         "n": bars["count"].values})
+        self._label = None
+
+    def load(self, prices):
+        # Seed the history from a finer price series (e.g. S5 closes).
+        self.history.clear()
+        self._extend(self._resample(prices))
+
+    def backfill(self, prices):
+        # Append only the bars after the last stored one (restart from a snapshot).
+        bars = self._resample(prices)
+        if len(self.history):
+            bars = bars[bars.index > self.history.last_time()]
+        self._extend(bars)
+
+    def update(self, time, price):
+        # Add one tick; returns the number of bars that were finished by it.
+        t = pd.Timestamp(time).value
+        label = (t // self._step + 1) * self._step
+        if self._label is None:
+            if len(self.history) and label <= self.history.times.last():
+                return 0 # tick belongs to a bar that is already in the history
+            self._start(label, price)
+            return 0
+        if label == self._label:
+            if price > self._h:
+                self._h = price
+            if price < self._l:
+                self._l = price
+            self._c = price
+            self._n += 1
+            return 0
+        if label < self._label:
+            return 0 # out-of-order tick from an earlier bar
+        self.history.append(self._label, {"o": self._o, "h": self._h, "l": self._l,
+                                          "c": self._c, "n": self._n})
+        # bars without ticks carry the last close forward (resample(...).last().ffill())
+        gap = (label - self._label) // self._step - 1
+        if gap > 0:
+            labels = self._label + self._step * np.arange(1, gap + 1, dtype = np.int64)
+            fill = np.full(gap, self._c)
+            self.history.extend(pd.to_datetime(labels, utc = True),
+                                {"o": fill, "h": fill, "l": fill, "c": fill, "n": np.zeros(gap)})
+        self._start(label, price)
+        return gap + 1
+
+    def _start(self, label, price):
+        self._label = label
+        self._o = self._h = self._l = self._c = price
+        self._n = 1
+
+    def frame(self, column, n = None):
+        # finished bars as a one-column close frame, the layout of raw_data
+        return pd.DataFrame({column: self.history.column("c", n)}, index = self.history.index(n), copy = False)
+
+    def last_time(self):
+        return self.history.last_time()
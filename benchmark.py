@@ -0,0 +1,94 @@
+import os
+import pickle
+import time
+import tracemalloc
+from contextlib import redirect_stdout
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+import numpy as np
+import pandas as pd
+from replay import synthetic_market, replay_trader
+from models import exported
+
+try:
+    import resource
+except ImportError: # Windows
+    resource = None
+
+
+def con_trader():
+    from Multi_Trader_2 import ConTrader
+    return ConTrader, dict(instrument = "EUR_USD", bar_length = "1min", window = 1, units = 100000, lags = 5,
+                           model = exported("logreg.pkl", ".npz"), p = 1, ind = 1, q = 0, SMA_S = 50, SMA_L = 200, SMA_Bol = 20,
+                           Dev = 1, Comb_Str = 2, arima_background = False)
+
+
+def dnn_trader():
+    from DNN_Trader_2 import DNNTrader2
+    params = pickle.load(open("params.pkl", "rb"))
+    return DNNTrader2, dict(instrument = "EUR_USD", bar_length = "1min", window = 50, lags = 5,
+                            LR_model = exported("Logistic_Regression_model2.sav", ".npz"),
+                            DNN_model = exported("DNN_model_3", ".tflite"),
+                            RF_model = exported("Random_Forest_3.sav", ".npz"),
+                            mu = params["mu"], std = params["std"], units = 100000, Comb_Str = 2)
+
+
+TRADERS = {"ConTrader": con_trader, "DNNTrader2": dnn_trader}
+
+
+def _max_rss_mb():
+    if resource is None:
+        return np.nan
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024 # kB on Linux
+
+
+def run_session(name, session, tick_interval = 2.0, seed = 0, trace_memory = False):
+    # one replayed session of trader name, measured in the process it runs in
+    trader_class, kwargs = TRADERS[name]()
+    candles, ticks = synthetic_market("2024-01-01 00:00", session = session, tick_interval = tick_interval, seed = seed)
+    trader = replay_trader(trader_class, candles, ticks, **kwargs)
+    with open(os.devnull, "w") as devnull, redirect_stdout(devnull): # the tick counter is printed on every tick
+        trader.get_most_recent()
+        rss_before = _max_rss_mb()
+        if trace_memory: # exact Python heap peak, but makes the run several times slower
+            tracemalloc.start()
+        start = time.perf_counter()
+        trader.stream_data(trader.instrument)
+        elapsed = time.perf_counter() - start
+        heap_peak = tracemalloc.get_traced_memory()[1] / 2**20 if trace_memory else np.nan
+        tracemalloc.stop()
+    trader.journal.close()
+    bars = trader.tick_seconds[trader.bar_ticks] * 1000
+    ticks_ms = trader.tick_seconds[~trader.bar_ticks] * 1000
+    tenth = max(len(bars) // 10, 1)
+    return {"trader": name, "session": session, "ticks": trader.ticks, "bars": len(bars),
+            "orders": len(trader.orders), "ticks_per_s": trader.ticks / elapsed,
+            "tick_p50_ms": np.percentile(ticks_ms, 50), "tick_p99_ms": np.percentile(ticks_ms, 99),
+            "bar_p50_ms": np.percentile(bars, 50), "bar_p99_ms": np.percentile(bars, 99),
+            # a growing ratio between the last and first tenth of the bars means per-bar work
+            # grows with the session (full-history recomputation)
+            "bar_first_ms": np.median(bars[:tenth]), "bar_last_ms": np.median(bars[-tenth:]),
+            "peak_rss_mb": _max_rss_mb(), "stream_rss_mb": _max_rss_mb() - rss_before, "heap_peak_mb": heap_peak}
+
+
+def benchmark(traders = ("ConTrader",), sessions = ("1h", "6h", "1d", "1w"), tick_interval = 2.0, seed = 0,
+              trace_memory = False):
+    # every session runs in a fresh process, so peak memory is that of the session alone
+    rows = []
+    for name in traders:
+        for session in sessions:
+            with ProcessPoolExecutor(max_workers = 1, mp_context = get_context("spawn")) as pool:
+                row = pool.submit(run_session, name, session, tick_interval, seed, trace_memory).result()
+            print(" | ".join("{} = {:.2f}".format(k, v) if isinstance(v, float) else "{} = {}".format(k, v)
+                             for k, v in row.items()), flush = True)
+            rows.append(row)
+    return pd.DataFrame(rows)
+
+
+if __name__ == "__main__":
+
+    os.chdir(os.path.dirname(os.path.abspath(__file__))) # model files are looked up here
+    results = benchmark(traders = ("ConTrader",), sessions = ("1h", "6h", "1d", "1w"))
+    pd.set_option("display.width", 200)
+    print(results.set_index(["trader", "session"]).round(2))
+    results.to_csv("benchmark_results.csv", index = False)
@@ -0,0 +1,154 @@
+import numpy as np
+import pandas as pd
+
+
+class RingBuffer:
+    # Fixed-capacity ring backed by a mirrored array of twice the capacity.
+    # Every value is written at slot i and i + capacity, so the most recent
+    # values are always contiguous in memory and view() never copies.
+    def __init__(self, capacity, dtype = np.float64):
+        self.capacity = int(capacity)
+        if self.capacity < 1:
+            raise ValueError("capacity must be positive")
+        self._data = np.zeros(2 * self.capacity, dtype = dtype)
+        self._end = 0
+        self.size = 0
+
+    @property
+    def dtype(self):
+        return self._data.dtype
+
+    def __len__(self):
+        return self.size
+
+    def append(self, value):
+        i = self._end
+        self._data[i] = value
+        self._data[i + self.capacity] = value
+        self._end = (i + 1) % self.capacity
+        if self.size < self.capacity:
+            self.size += 1
+
+    def extend(self, values):
+        values = np.asarray(values, dtype = self._data.dtype)[-self.capacity:]
+        n = len(values)
+        if n == 0:
+            return
+        idx = (self._end + np.arange(n)) % self.capacity
+        self._data[idx] = values
+        self._data[idx + self.capacity] = values
+        self._end = (self._end + n) % self.capacity
+        self.size = min(self.size + n, self.capacity)
+
+    def view(self, n = None):
+        # zero-copy view of the last n values (all stored values by default), oldest first
+        n = self.size if n is None else min(n, self.size)
+        stop = self._end + self.capacity
+        return self._data[stop - n:stop]
+
+    def last(self):
+        if self.size == 0:
+            raise IndexError("empty buffer")
+        return self._data[self._end + self.capacity - 1]
+
+    def keep_last(self, n = 1):
+        self.size = min(self.size, n)
+
+    def clear(self):
+        self.size = 0
+
+
+class TickBuffer:
+    # Preallocated store for streamed mid prices: O(1) appends instead of
+    # DataFrame.append (which copied the whole frame per tick and is gone in pandas 2.x).
+    def __init__(self, capacity = 50000):
+        self.times = RingBuffer(capacity, dtype = np.int64)
+        self.prices = RingBuffer(capacity, dtype = np.float64)
+
+    def __len__(self):
+        return len(self.prices)
+
+    def append(self, time, price):
+        self.times.append(pd.Timestamp(time).value)
+        self.prices.append(price)
+
+    def last_time(self):
+        return pd.Timestamp(int(self.times.last()), tz = "UTC")
+
+    def keep_last(self, n = 1):
+        self.times.keep_last(n)
+        self.prices.keep_last(n)
+
+    def clear(self):
+        self.times.clear()
+        self.prices.clear()
+
+
+class FrameBuffer:
+    # Column-oriented ring of rows keyed by UTC timestamps. Each column is its
+    # own RingBuffer, so reading a column or building a frame is a view, and the
+    # memory held is fixed by the capacity rather than by the session length.
+    def __init__(self, capacity, columns, dtype = np.float64):
+        self.capacity = int(capacity)
+        self.columns = list(columns)
+        self.times = RingBuffer(self.capacity, dtype = np.int64)
+        self.data = {col: RingBuffer(self.capacity, dtype = dtype) for col in self.columns}
+
+    def __len__(self):
+        return len(self.times)
+
+    def append(self, time, values):
+        self.times.append(time if isinstance(time, (int, np.integer)) else pd.Timestamp(time).value)
+        for col in self.columns:
+            self.data[col].append(values[col])
+
+    def extend(self, times, values):
+        times = pd.DatetimeIndex(times)
+        if times.tz is None:
+            times = times.tz_localize("UTC")
+        self.times.extend(times.as_unit("ns").asi8)
+        for col in self.columns:
+            self.data[col].extend(values[col])
+
+    def load(self, times, values):
+        # replace the contents with stored columns (times in UTC ns), e.g. from a Snapshot
+        self.clear()
+        self.times.extend(times)
+        for col in self.columns:
+            self.data[col].extend(values[col])
+
+    def column(self, col, n = None):
+        return self.data[col].view(n)
+
+    def index(self, n = None):
+        return pd.DatetimeIndex(self.times.view(n).view("M8[ns]")).tz_localize("UTC")
+
+    def at(self, times, columns = None):
+        # values of the rows labelled times (UTC ns) as float64, NaN where there is no such row
+        columns = self.columns if columns is None else columns
+        stored = self.times.view()
+        pos = np.searchsorted(stored, times)
+        found = pos < len(stored)
+        found[found] = stored[pos[found]] == np.asarray(times)[found]
+        out = {}
+        for col in columns:
+            out[col] = np.full(len(pos), np.nan)
+            out[col][found] = self.data[col].view()[pos[found]]
+        return out
+
+    def frame(self, columns = None, n = None):
+        # a view: the next append or extend overwrites it in place, copy() what is kept
+        columns = self.columns if columns is None else columns
+        return pd.DataFrame({col: self.data[col].view(n) for col in columns},
+                            index = self.index(n), copy = False)
+
+    def last_time(self):
+        return pd.Timestamp(int(self.times.last()), tz = "UTC")
+
+    def last(self, col):
+        return self.data[col].last()
+
+    def clear(self):
+        self.times.clear()
+        for buf in self.data.values():
+            buf.clear()
@@ -0,0 +1,135 @@
+import os
+import json
+import numpy as np
+import pandas as pd
+
+
+class HistoryCache:
+    # On-disk candle store, one memory-mapped .npy file per day:
+    #   root/<instrument>/<granularity>/<YYYY-MM-DD>.npy
+    # Only complete candles are written. get_history serves what is on disk and downloads
+    # only the part of the requested range that is not there yet, so a restart (and every
+    # 2 second poll of get_most_recent) fetches just the tail. Backtests and offline runs
+    # read the same files through read().
+    DTYPE = np.dtype([("t", "<i8"), ("o", "<f8"), ("h", "<f8"), ("l", "<f8"), ("c", "<f8"), ("volume", "<i8")])
+    COLUMNS = ["o", "h", "l", "c", "volume"]
+
+    def __init__(self, root = "history"):
+        self.root = root
+
+    def _dir(self, instrument, granularity):
+        return os.path.join(self.root, instrument, granularity)
+
+    def _days(self, instrument, granularity):
+        folder = self._dir(instrument, granularity)
+        if not os.path.isdir(folder):
+            return []
+        return sorted(f[:-4] for f in os.listdir(folder) if f.endswith(".npy"))
+
+    @staticmethod
+    def _utc(time):
+        time = pd.Timestamp(time)
+        return time.tz_localize("UTC") if time.tz is None else time.tz_convert("UTC")
+
+    def _load(self, instrument, granularity, day):
+        return np.load(os.path.join(self._dir(instrument, granularity), day + ".npy"), mmap_mode = "r")
+
+    def _save(self, instrument, granularity, day, data):
+        folder = self._dir(instrument, granularity)
+        os.makedirs(folder, exist_ok = True)
+        path = os.path.join(folder, day + ".npy")
+        with open(path + ".tmp", "wb") as f:
+            np.save(f, data)
+        os.replace(path + ".tmp", path) # readers never see a half-written day
+
+    def _coverage_path(self, instrument, granularity):
+        return os.path.join(self._dir(instrument, granularity), "coverage.json")
+
+    def coverage_start(self, instrument, granularity):
+        # earliest time that has been downloaded (days without candles have no file)
+        try:
+            with open(self._coverage_path(instrument, granularity)) as f:
+                return pd.Timestamp(json.load(f)["start"])
+        except (OSError, KeyError, ValueError):
+            return None
+
+    def read(self, instrument, granularity, start = None, end = None):
+        days = self._days(instrument, granularity)
+        if start is not None:
+            start = self._utc(start)
+            days = [d for d in days if d >= str(start.date())]
+        if end is not None:
+            end = self._utc(end)
+            days = [d for d in days if d <= str(end.date())]
+        if not days:
+            return pd.DataFrame(columns = self.COLUMNS, index = pd.DatetimeIndex([], tz = "UTC"), dtype = float)
+        parts = [self._load(instrument, granularity, d) for d in days]
+        data = parts[0] if len(parts) == 1 else np.concatenate(parts)
+        lo = 0 if start is None else np.searchsorted(data["t"], start.value, side = "left")
+        hi = len(data) if end is None else np.searchsorted(data["t"], end.value, side = "right")
+        data = data[lo:hi]
+        index = pd.DatetimeIndex(data["t"].view("M8[ns]")).tz_localize("UTC")
+        return pd.DataFrame({col: data[col] for col in self.COLUMNS}, index = index)
+
+    def last_time(self, instrument, granularity):
+        days = self._days(instrument, granularity)
+        if not days:
+            return None
+        return pd.Timestamp(int(self._load(instrument, granularity, days[-1])["t"][-1]), tz = "UTC")
+
+    def write(self, instrument, granularity, df):
+        if "complete" in df.columns:
+            df = df[df["complete"].astype(bool)]
+        if len(df) == 0:
+            return
+        index = pd.DatetimeIndex(df.index)
+        index = index.tz_localize("UTC") if index.tz is None else index.tz_convert("UTC")
+        new = np.empty(len(df), dtype = self.DTYPE)
+        new["t"] = index.as_unit("ns").asi8
+        for col in self.COLUMNS:
+            new[col] = df[col].values
+        days = index.strftime("%Y-%m-%d")
+        for day in np.unique(days):
+            chunk = new[days == day]
+            if day in self._days(instrument, granularity):
+                chunk = np.concatenate([np.array(self._load(instrument, granularity, day)), chunk])
+            # keep the latest copy of every candle, in time order
+            _, last = np.unique(chunk["t"][::-1], return_index = True)
+            self._save(instrument, granularity, day, chunk[::-1][last])
+
+    def _fetch(self, api, instrument, start, end, granularity, price):
+        df = api.get_history(instrument = instrument, start = start.tz_localize(None).to_pydatetime(),
+                             end = end.tz_localize(None).to_pydatetime(), granularity = granularity,
+                             price = price, localize = False)
+        self.write(instrument, granularity, df)
+        return df
+
+    def _set_coverage(self, instrument, granularity, start):
+        os.makedirs(self._dir(instrument, granularity), exist_ok = True)
+        with open(self._coverage_path(instrument, granularity), "w") as f:
+            json.dump({"start": str(start)}, f)
+
+    def get_history(self, api, instrument, start, end, granularity, price = "M"):
+        # drop-in for tpqoa.get_history(..., localize = False) backed by the cache
+        start, end = self._utc(start), self._utc(end)
+        covered = self.coverage_start(instrument, granularity)
+        last = self.last_time(instrument, granularity)
+        tail = None
+        if covered is None or last is None:
+            tail = self._fetch(api, instrument, start, end, granularity, price)
+            self._set_coverage(instrument, granularity, start)
+        else:
+            if start < covered:
+                self._fetch(api, instrument, start, covered, granularity, price)
+                self._set_coverage(instrument, granularity, start)
+            if end > last:
+                tail = self._fetch(api, instrument, last, end, granularity, price)
+        df = self.read(instrument, granularity, start, end)
+        if tail is not None and "complete" in tail.columns:
+            # the candle still forming is returned but never stored
+            pending = tail.loc[~tail["complete"].astype(bool), self.COLUMNS]
+            pending.index = pd.to_datetime(pending.index, utc = True)
+            if len(df):
+                pending = pending[pending.index > df.index[-1]]
+            df = pd.concat([df, pending]) if len(pending) else df
+        return df
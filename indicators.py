@@ -0,0 +1,243 @@
+import math
+from collections import deque
+from time import perf_counter
+import numpy as np
+from buffers import FrameBuffer
+
+#************************** rolling primitives ******************************
+# Each primitive updates in O(1) per value and returns NaN until its window is
+# full (pandas' rolling(window) default).
+
+class RollingMean:
+    def __init__(self, window):
+        self.window = window
+        self.values = deque(maxlen = window)
+        self.total = 0.0
+        self._updates = 0
+
+    def update(self, x):
+        if len(self.values) == self.window:
+            self.total -= self.values[0]
+        self.values.append(x)
+        self.total += x
+        self._updates += 1
+        if self._updates % (64 * self.window) == 0: # resync to bound floating point drift
+            self.total = math.fsum(self.values)
+        return self.value
+
+    @property
+    def value(self):
+        if len(self.values) < self.window:
+            return np.nan
+        return np.float64(self.total) / self.window
+
+
+class RollingStd:
+    # Welford's running variance, extended to a sliding window by replacing the
+    # oldest value instead of only adding new ones.
+    def __init__(self, window, ddof = 1):
+        self.window = window
+        self.ddof = ddof
+        self.values = deque(maxlen = window)
+        self.mean = 0.0
+        self.m2 = 0.0
+        self._updates = 0
+
+    def _step(self, x):
+        n = len(self.values)
+        if n == self.window:
+            old = self.values[0]
+            mean = self.mean + (x - old) / n
+            m2 = self.m2 + (x - old) * (x - mean + old - self.mean)
+        else:
+            delta = x - self.mean
+            mean = self.mean + delta / (n + 1)
+            m2 = self.m2 + delta * (x - mean)
+        return mean, max(m2, 0.0)
+
+    def update(self, x):
+        self.mean, self.m2 = self._step(x)
+        self.values.append(x)
+        self._updates += 1
+        if self._updates % (64 * self.window) == 0: # resync to bound floating point drift
+            self.mean = math.fsum(self.values) / len(self.values)
+            self.m2 = math.fsum((v - self.mean) ** 2 for v in self.values)
+        return self.value
+
+    def _std(self, m2):
+        return np.sqrt(np.float64(m2) / (self.window - self.ddof))
+
+    @property
+    def value(self):
+        if len(self.values) < self.window:
+            return np.nan
+        return self._std(self.m2)
+
+
+class RollingMax:
+    # Monotonic deque of (position, value): the front is always the extreme of
+    # the current window, every value is pushed and popped at most once.
+    _sign = 1.0
+
+    def __init__(self, window):
+        self.window = window
+        self.deque = deque()
+        self.count = 0
+
+    def update(self, x):
+        key = self._sign * x
+        while self.deque and self.deque[-1][1] <= key:
+            self.deque.pop()
+        self.deque.append((self.count, key))
+        self.count += 1
+        while self.deque[0][0] < self.count - self.window:
+            self.deque.popleft()
+        return self.value
+
+    @property
+    def value(self):
+        if self.count < self.window:
+            return np.nan
+        return np.float64(self._sign * self.deque[0][1])
+
+
+class RollingMin(RollingMax):
+    _sign = -1.0
+
+
+#************************** indicator engines *******************************
+
+class IndicatorEngine:
+    # Feeds finished bars into update() one at a time and keeps the outputs in a
+    # bounded FrameBuffer aligned with the bar history.
+    COLUMNS = []
+
+    def __init__(self, capacity = 10000):
+        self.history = FrameBuffer(capacity, self.COLUMNS)
+        self.last_time = None # label (ns) of the last bar fed in
+        self.warmup = 1 # bars needed to rebuild the rolling state (longest window + 1)
+
+    def sync(self, bars, column = "c"):
+        # bars: FrameBuffer of finished bars (BarBuilder.history); returns the number of new bars
+        times = bars.times.view()
+        start = 0 if self.last_time is None else np.searchsorted(times, self.last_time, side = "right")
+        for t, price in zip(times[start:], bars.column(column)[start:]):
+            self.history.append(t, self.update(float(price)))
+            self.last_time = t
+        return len(times) - start
+
+    def update(self, price):
+        raise NotImplementedError
+
+    def restore(self, times, values, bars, column = "c"):
+        # Outputs from a Snapshot. The rolling windows are rebuilt by running the last
+        # `warmup` bars up to the stored last bar through update() (outputs discarded).
+        self.history.load(times, values)
+        self.last_time = int(times[-1])
+        end = np.searchsorted(bars.times.view(), self.last_time, side = "right")
+        for price in bars.column(column)[:end][-self.warmup:]:
+            self.update(float(price))
+
+
+class ConIndicators(IndicatorEngine):
+    # Contrarian, SMA and Bollinger columns of ConTrader.define_strategy. Each sync()
+    # leaves the seconds spent on each of the three sub-strategies in self.timings.
+    STAGES = ["Contrarian", "SMA", "Bollinger"]
+    COLUMNS = ["Contrarian_returns", "Contrarian_position", "SMA_S", "SMA_L", "SMA_position",
+               "SMA_Bol", "Lower_Bol", "Upper_Bol", "distance", "Bol_position"]
+
+    def __init__(self, window, SMA_S, SMA_L, SMA_Bol, Dev, capacity = 10000):
+        super().__init__(capacity)
+        self.Dev = Dev
+        self.returns_mean = RollingMean(window)
+        self.sma_s = RollingMean(SMA_S)
+        self.sma_l = RollingMean(SMA_L)
+        self.bol_mean = RollingMean(SMA_Bol)
+        self.bol_std = RollingStd(SMA_Bol)
+        self._prev_price = None
+        self._prev_distance = np.nan
+        self._bol_position = 0.0
+        self.warmup = max(window, SMA_S, SMA_L, SMA_Bol) + 1
+        self.timings = dict.fromkeys(self.STAGES, 0.0)
+
+    def sync(self, bars, column = "c"):
+        self.timings = dict.fromkeys(self.STAGES, 0.0)
+        return super().sync(bars, column)
+
+    def restore(self, times, values, bars, column = "c"):
+        super().restore(times, values, bars, column)
+        # the Bollinger position is carried from bar to bar, continue from the stored one
+        if not np.isnan(self.history.last("Bol_position")):
+            self._bol_position = float(self.history.last("Bol_position"))
+            self._prev_distance = float(self.history.last("distance"))
+
+    def update(self, price):
+        t0 = perf_counter()
+        ret = np.log(price / self._prev_price) if self._prev_price is not None else np.nan
+        self._prev_price = price
+        con_position = -np.sign(self.returns_mean.update(ret)) if not np.isnan(ret) else np.nan
+
+        t1 = perf_counter()
+        sma_s = self.sma_s.update(price)
+        sma_l = self.sma_l.update(price)
+        sma_position = np.nan if np.isnan(sma_l) or np.isnan(sma_s) else (1.0 if sma_s > sma_l else -1.0)
+
+        t2 = perf_counter()
+        mean = self.bol_mean.update(price)
+        std = self.bol_std.update(price)
+        lower = mean - std * self.Dev
+        upper = mean + std * self.Dev
+        distance = price - mean
+        if np.isnan(distance):
+            bol_position = np.nan
+        else:
+            if price < lower:
+                self._bol_position = 1.0
+            elif price > upper:
+                self._bol_position = -1.0
+            if distance * self._prev_distance < 0:
+                self._bol_position = 0.0
+            bol_position = self._bol_position
+            self._prev_distance = distance
+        t3 = perf_counter()
+        self.timings["Contrarian"] += t1 - t0
+        self.timings["SMA"] += t2 - t1
+        self.timings["Bollinger"] += t3 - t2
+        return {"Contrarian_returns": ret, "Contrarian_position": con_position,
+                "SMA_S": sma_s, "SMA_L": sma_l, "SMA_position": sma_position,
+                "SMA_Bol": mean, "Lower_Bol": lower, "Upper_Bol": upper,
+                "distance": distance, "Bol_position": bol_position}
+
+
+class DNNFeatures(IndicatorEngine):
+    # Feature set of DNNTrader2.define_strategy
+    COLUMNS = ["returns", "dir", "sma", "boll", "min", "max", "mom", "vol"]
+
+    def __init__(self, window, long_window = 150, mom_window = 3, capacity = 10000):
+        super().__init__(capacity)
+        self.sma_w = RollingMean(window)
+        self.sma_long = RollingMean(long_window)
+        self.std_w = RollingStd(window)
+        self.min_w = RollingMin(window)
+        self.max_w = RollingMax(window)
+        self.mom = RollingMean(mom_window)
+        self.vol = RollingStd(window)
+        self._prev_price = None
+        self.warmup = max(window, long_window, mom_window) + 1
+
+    def _row(self, price, ret, sma_w, sma_long, std_w, min_w, max_w, mom, vol):
+        return {"returns": ret, "dir": 1.0 if ret > 0 else -1.0, "sma": sma_w - sma_long,
+                "boll": (price - sma_w) / std_w, "min": min_w / price - 1, "max": max_w / price - 1,
+                "mom": mom, "vol": vol}
+
+    def update(self, price):
+        ret = np.log(price / self._prev_price) if self._prev_price is not None else np.nan
+        self._prev_price = price
+        if np.isnan(ret):
+            mom = vol = np.nan
+        else:
+            mom = self.mom.update(ret)
+            vol = self.vol.update(ret)
+        return self._row(price, ret, self.sma_w.update(price), self.sma_long.update(price),
+                         self.std_w.update(price), self.min_w.update(price), self.max_w.update(price),
+                         mom, vol)
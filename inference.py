@@ -0,0 +1,45 @@
+import numpy as np
+import pandas as pd
+from numpy.lib.stride_tricks import sliding_window_view
+
+
+def lag_matrix(columns, lags, rows = 1, next_row = False):
+    # Lagged feature rows for the newest `rows` targets, read through strided windows over
+    # the column views instead of shift()ing the whole history. The lags of a target are
+    # the `lags` values before it. With next_row the last target is the row after the
+    # stored values (the latest tick). Output columns are feature-major, like
+    # f1_lag_1 .. f1_lag_n, f2_lag_1 .. f2_lag_n.
+    n = len(columns[0])
+    stop = n if next_row else n - 1
+    rows = max(min(rows, stop - lags + 1), 0)
+    if rows == 0:
+        return np.empty((0, lags * len(columns)))
+    start = stop - lags - rows + 1
+    return np.concatenate([sliding_window_view(col[start:stop], lags)[:, ::-1] for col in columns], axis = 1)
+
+
+class EnsembleScorer:
+    # Scores a batch of lag rows through several models: only the rows being scored are
+    # standardized, and every model is called once per batch.
+    def __init__(self, cols, models, mu = None, std = None):
+        self.cols = list(cols)
+        self.models = models # name -> callable(X) returning one prediction per row
+        self.set_params(mu, std)
+
+    def set_params(self, mu, std):
+        self.mu = None if mu is None else np.asarray(mu[self.cols], dtype = float)
+        self.std = None if std is None else np.asarray(std[self.cols], dtype = float)
+
+    def standardize(self, X):
+        if self.mu is None:
+            return X
+        return (X - self.mu) / self.std
+
+    def predict(self, X):
+        valid = ~np.isnan(X).any(axis = 1) # rows still inside the warm-up of some feature
+        out = {name: np.full(len(X), np.nan) for name in self.models}
+        if valid.any():
+            Xs = pd.DataFrame(self.standardize(X[valid]), columns = self.cols)
+            for name, predict in self.models.items():
+                out[name][valid] = np.asarray(predict(Xs), dtype = float).reshape(int(valid.sum()), -1)[:, 0]
+        return out
@@ -0,0 +1,196 @@
+import atexit
+import csv
+import queue
+import sqlite3
+import threading
+import time
+import uuid
+from datetime import datetime
+
+
+class SQLiteBackend:
+    # local runs and tests
+    placeholder = "?"
+    # errors caused by a row rather than by the connection
+    data_errors = (sqlite3.ProgrammingError, sqlite3.InterfaceError, sqlite3.IntegrityError, sqlite3.DataError,
+                   TypeError, ValueError)
+
+    def __init__(self, path = "trades.db"):
+        self.path = path
+
+    def connect(self):
+        sqlite3.register_adapter(datetime, lambda d: d.isoformat(" "))
+        return sqlite3.connect(self.path, check_same_thread = False)
+
+
+class MySQLBackend:
+    # production journal (TradesDB on the local MySQL server)
+    placeholder = "%s"
+
+    def __init__(self, host = "localhost", user = "root", passwd = "password", database = "TradesDB"):
+        self.host = host
+        self.user = user
+        self.passwd = passwd
+        self.database = database
+
+    def connect(self):
+        import pymysql
+        conn = pymysql.connect(host = self.host, user = self.user, passwd = self.passwd)
+        cursor = conn.cursor()
+        cursor.execute("CREATE DATABASE IF NOT EXISTS {}".format(self.database))
+        cursor.execute("USE {}".format(self.database))
+        return conn
+
+    @property
+    def data_errors(self):
+        # pymysql's InterfaceError is a closed connection, not a bad row
+        import pymysql
+        return (pymysql.err.ProgrammingError, pymysql.err.IntegrityError, pymysql.err.DataError, TypeError, ValueError)
+
+
+class TradeJournal:
+    # Trade log kept off the order path: record() only puts the row on a queue, and a
+    # background thread owns one persistent connection and writes rows in batches with
+    # executemany. The thread connects and creates the table as soon as it starts, and
+    # the constructor raises if that fails, so a wrong database configuration stops the
+    # trader at startup. close() (also run at exit) flushes everything still queued.
+    # A lost connection is retried with a backoff of up to max_backoff seconds, holding
+    # at most batch_size rows. A batch the database refuses is written row by row; the
+    # rows refused on their own go to reject_file (csv), as do the rows still unwritten
+    # when close() gives up on the connection, so one bad row never blocks the others.
+    def __init__(self, backend, table, batch_size = 100, flush_interval = 1.0, max_backoff = 60.0,
+                 close_retries = 3, reject_file = None):
+        self.backend = backend
+        self.table = table
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_backoff = max_backoff
+        self.close_retries = close_retries
+        self.reject_file = reject_file or "{}_rejected.csv".format(table)
+        self.queue = queue.Queue()
+        self.written = 0
+        self.rejected = 0
+        self._conn = None
+        self._closed = False
+        self._error = None
+        self._ready = threading.Event()
+        self._thread = threading.Thread(target = self._run, name = "journal-" + table, daemon = True)
+        self._thread.start()
+        self._ready.wait()
+        if self._error is not None:
+            raise self._error
+        atexit.register(self.close)
+
+    def record(self, instrument, time, units, price, pl, cumpl):
+        self.queue.put((str(uuid.uuid4()), time, instrument, units, price, pl, cumpl))
+
+    def _connect(self):
+        conn = self.backend.connect()
+        cursor = conn.cursor()
+        cursor.execute(f'CREATE TABLE IF NOT EXISTS {self.table} (TradeID CHAR(40) NOT NULL PRIMARY KEY,time DATETIME,Instrument CHAR(40), Units INT(20),Price FLOAT(10),pnl FLOAT(10),CumPnL FLOAT(10))')
+        conn.commit()
+        return conn
+
+    def _write(self, batch):
+        if self._conn is None: # after a lost connection
+            self._conn = self._connect()
+        p = self.backend.placeholder
+        sql = f"INSERT INTO {self.table} (TradeID,time,Instrument,Units,Price,pnl,CumPnL) VALUES ({','.join([p] * 7)})"
+        cursor = self._conn.cursor()
+        try:
+            cursor.executemany(sql, batch)
+            self._conn.commit()
+        except self.backend.data_errors:
+            self._conn.rollback()
+            raise
+        self.written += len(batch)
+
+    def _write_rows(self, batch):
+        # one row at a time, the rows refused are diverted; a lost connection leaves the
+        # rows not written yet in batch
+        while batch:
+            try:
+                self._write(batch[:1])
+            except self.backend.data_errors as e:
+                self._reject(batch[:1], e)
+            del batch[0]
+
+    def _reject(self, rows, error):
+        self.rejected += len(rows)
+        print("\nTrade journal: {} row(s) not written ({}), kept in {}".format(len(rows), error, self.reject_file))
+        try:
+            with open(self.reject_file, "a", newline = "") as f:
+                csv.writer(f).writerows(rows)
+        except OSError as e:
+            print("Trade journal: cannot write {}: {} | rows: {}".format(self.reject_file, e, rows))
+
+    def _disconnect(self):
+        try:
+            self._conn.close()
+        except Exception:
+            pass
+        self._conn = None
+
+    def _run(self):
+        try:
+            self._conn = self._connect()
+        except Exception as e:
+            self._error = e
+            return
+        finally:
+            self._ready.set()
+        batch = []
+        stop = False
+        failures = 0
+        while not stop or batch:
+            if not stop and len(batch) < self.batch_size:
+                try:
+                    item = self.queue.get(timeout = self.flush_interval)
+                    while item is not None:
+                        batch.append(item)
+                        if len(batch) >= self.batch_size:
+                            break
+                        item = self.queue.get_nowait()
+                    stop = item is None
+                except queue.Empty:
+                    pass
+            if not batch:
+                continue
+            try:
+                try:
+                    self._write(batch)
+                    batch = []
+                except self.backend.data_errors:
+                    self._write_rows(batch)
+                failures = 0
+            except Exception as e: # the connection: reconnect and retry the batch
+                failures += 1
+                if self._conn is not None:
+                    self._disconnect()
+                if stop and failures > self.close_retries:
+                    self._reject(batch + self._drain(), e)
+                    batch = []
+                    break
+                wait = min(self.flush_interval * 2 ** (failures - 1), self.max_backoff)
+                print("\nTrade journal write failed ({} rows pending), retrying in {:.0f}s: {}".format(len(batch), wait, e))
+                time.sleep(wait)
+        if self._conn is not None:
+            self._conn.close()
+
+    def _drain(self):
+        # rows still queued behind the batch at close
+        rows = []
+        while True:
+            try:
+                item = self.queue.get_nowait()
+            except queue.Empty:
+                return rows
+            if item is not None:
+                rows.append(item)
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self.queue.put(None)
+        self._thread.join()
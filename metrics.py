@@ -0,0 +1,229 @@
+import os
+import sys
+import signal
+import threading
+import time
+from collections import Counter, deque
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+
+
+class LatencyHistogram:
+    # Fixed buckets (cumulative in the Prometheus export) plus the most recent samples,
+    # from which p50/p99 are read exactly.
+    BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+               0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+    def __init__(self, window = 10000):
+        self.counts = np.zeros(len(self.BUCKETS) + 1, dtype = np.int64) # last one is +Inf
+        self.samples = deque(maxlen = window)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, seconds):
+        self.counts[np.searchsorted(self.BUCKETS, seconds)] += 1
+        self.samples.append(seconds)
+        self.count += 1
+        self.sum += seconds
+
+    def quantile(self, q):
+        return float(np.quantile(self.samples, q)) if self.samples else float("nan")
+
+
+class SamplingProfiler:
+    # Statistical profiler for a running bot: a daemon thread looks at the stacks of all
+    # other threads every interval seconds and counts them. dump() writes the counts in
+    # collapsed-stack format ("frame;frame;frame count"), which flamegraph.pl and
+    # speedscope read directly.
+    def __init__(self, interval = 0.005):
+        self.interval = interval
+        self.stacks = Counter()
+        self._thread = None
+        self._stop = threading.Event()
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        if self.running:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target = self._run, name = "profiler", daemon = True)
+        self._thread.start()
+
+    def stop(self):
+        if self.running:
+            self._stop.set()
+            self._thread.join()
+
+    def _run(self):
+        own = threading.get_ident()
+        names = {}
+        while not self._stop.wait(self.interval):
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                if ident not in names:
+                    names = {t.ident: t.name for t in threading.enumerate()}
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append("{}:{}".format(os.path.basename(code.co_filename), code.co_name))
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def collapsed(self):
+        return "".join("{} {}\n".format(stack, n) for stack, n in self.stacks.most_common())
+
+    def dump(self, path):
+        with open(path + ".tmp", "w") as f:
+            f.write(self.collapsed())
+        os.replace(path + ".tmp", path)
+
+    def reset(self):
+        self.stacks = Counter()
+
+
+class Metrics:
+    # Per-stage latencies of a trader. Stages are timed with
+    #   with metrics.timer("define_strategy"): ...
+    # or by wrapping a callable with timed(). observe() records a latency measured
+    # elsewhere (tick_to_order). The numbers can be printed (report), written to a file in
+    # Prometheus text format (write, or export for a periodic background write) or scraped
+    # from serve(), which also switches the sampling profiler on and off at runtime:
+    #   GET /metrics | /profile/start | /profile/stop | /profile
+    def __init__(self, labels = None, window = 10000, profile_interval = 0.005):
+        self.labels = labels or {}
+        self.window = window
+        self.histograms = {}
+        self.profiler = SamplingProfiler(profile_interval)
+        self._lock = threading.Lock()
+        self._server = None
+        self._export = None
+
+    def observe(self, stage, seconds):
+        with self._lock:
+            if stage not in self.histograms:
+                self.histograms[stage] = LatencyHistogram(self.window)
+            self.histograms[stage].observe(seconds)
+
+    @contextmanager
+    def timer(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start)
+
+    def timed(self, stage, func):
+        def wrapper(*args, **kwargs):
+            with self.timer(stage):
+                return func(*args, **kwargs)
+        return wrapper
+
+    def summary(self):
+        with self._lock:
+            return {stage: {"count": h.count, "p50_ms": h.quantile(0.5) * 1000,
+                            "p99_ms": h.quantile(0.99) * 1000, "max_ms": max(h.samples, default = 0) * 1000}
+                    for stage, h in self.histograms.items()}
+
+    def report(self):
+        print("\n{:<24}{:>8}{:>12}{:>12}{:>12}".format("stage", "count", "p50 ms", "p99 ms", "max ms"))
+        for stage, s in self.summary().items():
+            print("{:<24}{:>8}{:>12.3f}{:>12.3f}{:>12.3f}".format(stage, s["count"], s["p50_ms"], s["p99_ms"], s["max_ms"]))
+
+    def _labels(self, **extra):
+        labels = {**self.labels, **extra}
+        return "{" + ",".join('{}="{}"'.format(k, v) for k, v in labels.items()) + "}"
+
+    def prometheus(self):
+        lines = ["# HELP trader_stage_seconds Latency of a trader stage.",
+                 "# TYPE trader_stage_seconds histogram"]
+        quantiles = ["# HELP trader_stage_seconds_recent Quantiles over the most recent samples of a stage.",
+                     "# TYPE trader_stage_seconds_recent gauge"]
+        with self._lock:
+            for stage, h in self.histograms.items():
+                cumulative = np.cumsum(h.counts)
+                for le, n in zip(list(h.BUCKETS) + ["+Inf"], cumulative):
+                    lines.append("trader_stage_seconds_bucket{} {}".format(self._labels(stage = stage, le = le), n))
+                lines.append("trader_stage_seconds_sum{} {}".format(self._labels(stage = stage), h.sum))
+                lines.append("trader_stage_seconds_count{} {}".format(self._labels(stage = stage), h.count))
+                for q in (0.5, 0.99):
+                    quantiles.append("trader_stage_seconds_recent{} {}".format(self._labels(stage = stage, quantile = q), h.quantile(q)))
+        return "\n".join(lines + quantiles) + "\n"
+
+    def write(self, path):
+        with open(path + ".tmp", "w") as f:
+            f.write(self.prometheus())
+        os.replace(path + ".tmp", path) # node_exporter's textfile collector never reads a partial file
+
+    def export(self, path, interval = 60):
+        # rewrite path every interval seconds until close()
+        stop = threading.Event()
+        def run():
+            while not stop.wait(interval):
+                self.write(path)
+            self.write(path)
+        thread = threading.Thread(target = run, name = "metrics-export", daemon = True)
+        thread.start()
+        self._export = (stop, thread)
+
+    def serve(self, port = 8000, host = "127.0.0.1"):
+        metrics = self
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path == "/metrics":
+                    body = metrics.prometheus()
+                elif self.path == "/profile/start":
+                    metrics.profiler.start()
+                    body = "profiler started\n"
+                elif self.path == "/profile/stop":
+                    metrics.profiler.stop()
+                    body = "profiler stopped\n"
+                elif self.path == "/profile":
+                    body = metrics.profiler.collapsed()
+                else:
+                    self.send_error(404)
+                    return
+                data = body.encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args): # keep the tick output readable
+                pass
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target = self._server.serve_forever, name = "metrics-http", daemon = True).start()
+        return self._server.server_address[1]
+
+    def profile_on_signal(self, path = "profile.txt", signum = getattr(signal, "SIGUSR2", None)):
+        # `kill -USR2 <pid>` starts the profiler, the next one stops it and writes path
+        # (must be called from the main thread; not available on Windows)
+        if signum is None:
+            return
+        def toggle(*args):
+            if self.profiler.running:
+                self.profiler.stop()
+                self.profiler.dump(path)
+            else:
+                self.profiler.reset()
+                self.profiler.start()
+        signal.signal(signum, toggle)
+
+    def close(self):
+        self.profiler.stop()
+        if self._export is not None:
+            stop, thread = self._export
+            stop.set()
+            thread.join()
+            self._export = None
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
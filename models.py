@@ -0,0 +1,220 @@
+import os
+import pickle
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+_loader = ThreadPoolExecutor(max_workers = 4, thread_name_prefix = "model-load")
+
+
+def _rows(X, feature_names):
+    # DataFrame columns in training order (like sklearn's feature name check), as floats
+    if feature_names is not None and hasattr(X, "columns") and list(X.columns) != feature_names:
+        X = X[feature_names]
+    return np.asarray(X, dtype = np.float64)
+
+
+class LinearModel:
+    # LogisticRegression.predict as a matrix product over exported coefficients:
+    # no sklearn import, no input validation, a few microseconds per bar
+    def __init__(self, coef, intercept, classes, feature_names = None):
+        self.coef = np.asarray(coef, dtype = np.float64)
+        self.intercept = np.asarray(intercept, dtype = np.float64)
+        self.classes = np.asarray(classes)
+        self.feature_names = None if feature_names is None else list(feature_names)
+
+    @classmethod
+    def from_sklearn(cls, model):
+        return cls(model.coef_, model.intercept_, model.classes_, getattr(model, "feature_names_in_", None))
+
+    def decision_function(self, X):
+        return _rows(X, self.feature_names) @ self.coef.T + self.intercept
+
+    def predict(self, X):
+        scores = self.decision_function(X)
+        if scores.shape[1] == 1:
+            return self.classes[(scores[:, 0] > 0).astype(int)]
+        return self.classes[scores.argmax(axis = 1)]
+
+    def arrays(self):
+        return {"coef": self.coef, "intercept": self.intercept, "classes": self.classes}
+
+
+class ForestModel:
+    # RandomForestClassifier.predict over the exported trees. The trees are stacked into
+    # padded node arrays and walked level by level for all trees and rows at once (leaves
+    # point at themselves), so a predict costs about depth vectorized steps.
+    def __init__(self, feature, threshold, left, right, value, classes, feature_names = None):
+        self.feature = np.asarray(feature, dtype = np.int64)     # (trees, nodes), -1 at leaves
+        self.threshold = np.asarray(threshold, dtype = np.float64)
+        self.left = np.asarray(left, dtype = np.int64)
+        self.right = np.asarray(right, dtype = np.int64)
+        self.value = np.asarray(value, dtype = np.float64)       # (trees, nodes, classes), class fractions
+        self.classes = np.asarray(classes)
+        self.feature_names = None if feature_names is None else list(feature_names)
+
+    @classmethod
+    def from_sklearn(cls, model):
+        trees = [est.tree_ for est in model.estimators_]
+        n = max(t.node_count for t in trees)
+        shape = (len(trees), n)
+        feature, left, right = np.full(shape, -1), np.zeros(shape, dtype = np.int64), np.zeros(shape, dtype = np.int64)
+        threshold = np.zeros(shape)
+        value = np.zeros(shape + (len(model.classes_),))
+        for i, t in enumerate(trees):
+            m = t.node_count
+            leaf = t.children_left[:m] == -1
+            feature[i, :m] = np.where(leaf, -1, t.feature[:m])
+            threshold[i, :m] = t.threshold[:m]
+            left[i, :m] = np.where(leaf, np.arange(m), t.children_left[:m]) # leaves point at themselves
+            right[i, :m] = np.where(leaf, np.arange(m), t.children_right[:m])
+            counts = t.value[:m, 0, :]
+            value[i, :m] = counts / counts.sum(axis = 1, keepdims = True)
+        return cls(feature, threshold, left, right, value, model.classes_, getattr(model, "feature_names_in_", None))
+
+    def predict_proba(self, X):
+        X = _rows(X, self.feature_names).astype(np.float32).astype(np.float64) # sklearn splits on float32 inputs
+        trees = np.arange(len(self.feature))[:, None]
+        rows = np.arange(len(X))[None, :]
+        node = np.zeros((len(self.feature), len(X)), dtype = np.int64)
+        while True:
+            feat = self.feature[trees, node]
+            if (feat < 0).all(): # every tree is at a leaf for every row
+                break
+            go_left = X[rows, np.maximum(feat, 0)] <= self.threshold[trees, node]
+            node = np.where(go_left, self.left[trees, node], self.right[trees, node])
+        return self.value[trees, node].mean(axis = 0)
+
+    def predict(self, X):
+        return self.classes[self.predict_proba(X).argmax(axis = 1)]
+
+    def arrays(self):
+        return {"feature": self.feature, "threshold": self.threshold, "left": self.left, "right": self.right,
+                "value": self.value, "classes": self.classes}
+
+
+class KerasModel:
+    # calls the network directly: keras' predict() builds a data pipeline on every call,
+    # which costs more than the forward pass for the handful of rows scored per bar
+    def __init__(self, model):
+        self.model = model
+
+    def predict(self, X, verbose = 0):
+        return np.asarray(self.model(np.asarray(X, dtype = np.float32), training = False))
+
+
+class TFLiteModel:
+    # DNN exported with export_tflite(), run with the TFLite interpreter on CPU
+    # (tflite_runtime if installed, which avoids importing TensorFlow at all)
+    def __init__(self, path):
+        try:
+            from tflite_runtime.interpreter import Interpreter
+        except ImportError:
+            from tensorflow.lite import Interpreter
+        self.interpreter = Interpreter(model_path = path)
+        self._input = self.interpreter.get_input_details()[0]["index"]
+        self._output = self.interpreter.get_output_details()[0]["index"]
+        self._rows = None
+
+    def predict(self, X, verbose = 0):
+        X = np.asarray(X, dtype = np.float32)
+        if self._rows != len(X):
+            self.interpreter.resize_tensor_input(self._input, X.shape)
+            self.interpreter.allocate_tensors()
+            self._rows = len(X)
+        self.interpreter.set_tensor(self._input, X)
+        self.interpreter.invoke()
+        return self.interpreter.get_tensor(self._output).copy()
+
+
+EXPORTS = {"linear": LinearModel, "forest": ForestModel}
+
+
+def load_model(path):
+    # by file type: .npz (exported LR / RF), .tflite, pickled sklearn models (.pkl, .sav),
+    # anything else is a Keras model (TensorFlow is only imported here)
+    ext = os.path.splitext(path)[1]
+    if ext == ".npz":
+        with np.load(path, allow_pickle = False) as f:
+            arrays = dict(f)
+        kind = str(arrays.pop("kind"))
+        names = arrays.pop("feature_names", None)
+        return EXPORTS[kind](**arrays, feature_names = names)
+    if ext == ".tflite":
+        return TFLiteModel(path)
+    if ext in (".pkl", ".sav", ".pickle"):
+        with open(path, "rb") as f:
+            return pickle.load(f)
+    from tensorflow import keras
+    return KerasModel(keras.models.load_model(path))
+
+
+class LazyModel:
+    # A model file loaded on a background thread from construction on, so the trader can
+    # download its history (get_most_recent) while the models load. The first predict
+    # waits for the load if it has not finished yet.
+    def __init__(self, source):
+        self.source = source # file or object, what a retraining process compares against
+        if isinstance(source, str):
+            self._future = _loader.submit(load_model, source)
+            self._model = None
+        else: # already loaded (a Keras model is called directly, see KerasModel)
+            self._future = None
+            self._model = KerasModel(source) if hasattr(source, "layers") else source
+
+    @property
+    def model(self):
+        if self._model is None:
+            self._model = self._future.result()
+        return self._model
+
+    def ready(self):
+        return self._future is None or self._future.done()
+
+    def predict(self, X, **kwargs):
+        return self.model.predict(X, **kwargs)
+
+
+def export_model(model, path):
+    # LogisticRegression -> .npz coefficients, RandomForestClassifier -> .npz node arrays,
+    # Keras -> .tflite (see load_model)
+    if isinstance(model, str):
+        model = load_model(model)
+    if hasattr(model, "estimators_"):
+        kind, model = "forest", ForestModel.from_sklearn(model)
+    elif hasattr(model, "coef_"):
+        kind, model = "linear", LinearModel.from_sklearn(model)
+    else:
+        return export_tflite(model, path)
+    arrays = model.arrays()
+    if model.feature_names is not None:
+        arrays["feature_names"] = np.asarray(model.feature_names, dtype = str)
+    with open(path + ".tmp", "wb") as f:
+        np.savez(f, kind = kind, **arrays)
+    os.replace(path + ".tmp", path)
+    return path
+
+
+def export_tflite(model, path):
+    import tensorflow as tf
+    model = getattr(model, "model", model)
+    converter = tf.lite.TFLiteConverter.from_keras_model(model)
+    with open(path, "wb") as f:
+        f.write(converter.convert())
+    return path
+
+
+def exported(path, ext):
+    # the exported artifact next to path if there is one ("logreg.pkl" -> "logreg.npz"), else path
+    fast = os.path.splitext(path)[0] + ext
+    return fast if os.path.exists(fast) else path
+
+
+if __name__ == "__main__":
+
+    # one-off conversion of the trained models to the lightweight formats
+    for source, target in [("logreg.pkl", "logreg.npz"),
+                           ("Logistic_Regression_model2.sav", "Logistic_Regression_model2.npz"),
+                           ("Random_Forest_3.sav", "Random_Forest_3.npz"),
+                           ("DNN_model_3", "DNN_model_3.tflite")]:
+        if os.path.exists(source):
+            print("{} -> {}".format(source, export_model(source, target)))
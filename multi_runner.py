@@ -0,0 +1,100 @@
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import pandas as pd
+import tpqoa
+
+
+class MultiRunner(tpqoa.tpqoa):
+    # Trades many instruments from one process and one price stream.
+    # The stream thread only routes each tick to its instrument's inbox and notices when a
+    # bar boundary is crossed. Everything that touches a trader (bar builder, strategy
+    # state, orders) runs on a worker pool, one job per instrument at a time, so a slow
+    # pair (ARIMA refit, DNN predict) never holds up ticks or orders of the others.
+    def __init__(self, conf_file, traders, workers = 4):
+        super().__init__(conf_file)
+        self.traders = {trader.instrument: trader for trader in traders}
+        self.pool = ThreadPoolExecutor(max_workers = workers)
+        self.ticks = 0
+        self.inbox = {instrument: deque() for instrument in self.traders}
+        self._labels = {instrument: None for instrument in self.traders}
+        self._busy = set()
+        self._pending = set()
+        self._lock = threading.Lock()
+
+    def get_most_recent(self, days = 5):
+        # warm up all instruments in parallel (history download, indicator and model state)
+        list(self.pool.map(lambda trader: trader.get_most_recent(days), self.traders.values()))
+
+    def stream(self, stop = None):
+        response = self.ctx_stream.pricing.stream(self.account_id, snapshot = True,
+                                                  instruments = ",".join(self.traders))
+        for msg_type, msg in response.parts():
+            if msg_type == "pricing.ClientPrice":
+                self.ticks += 1
+                self.on_tick(msg.instrument, msg.time, float(msg.bids[0].dict()["price"]),
+                             float(msg.asks[0].dict()["price"]))
+            if self.stop_stream or (stop is not None and self.ticks >= stop): # tpqoa's flag: set it to True to stop
+                break
+
+    def on_tick(self, instrument, time, bid, ask):
+        if instrument not in self.inbox:
+            return
+        self.inbox[instrument].append((time, bid, ask))
+        step = self.traders[instrument].bar_length.value
+        label = (pd.Timestamp(time).value // step + 1) * step
+        if self._labels[instrument] is not None and label > self._labels[instrument]:
+            self.schedule(instrument)
+        self._labels[instrument] = label
+
+    def schedule(self, instrument):
+        with self._lock:
+            if instrument in self._busy:
+                self._pending.add(instrument) # picked up as soon as the running job ends
+                return
+            self._busy.add(instrument)
+        self.pool.submit(self._process, instrument)
+
+    def _process(self, instrument):
+        trader = self.traders[instrument]
+        inbox = self.inbox[instrument]
+        try:
+            while inbox:
+                time, bid, ask = inbox.popleft()
+                trader.ticks = self.ticks
+                try: # a failing tick is reported and skipped, the ones behind it still run now
+                    trader.on_success(time, bid, ask) # bar building, define_strategy and execute_trades
+                except Exception as e:
+                    print("\n{} | strategy failed at {}: {}".format(instrument, time, e))
+        finally:
+            with self._lock:
+                self._busy.discard(instrument)
+                rerun = instrument in self._pending
+                self._pending.discard(instrument)
+            if rerun:
+                self.schedule(instrument)
+
+    def close_positions(self):
+        self.pool.shutdown(wait = True)
+        for trader in self.traders.values():
+            trader.order_manager.target(0, "GOING NEUTRAL") # close out, then wait for the pending orders
+            trader.order_manager.close()
+            trader.position = 0
+            trader.journal.close()
+            if hasattr(trader, "arima"):
+                trader.arima.close()
+
+
+if __name__ == "__main__":
+
+    from Multi_Trader_2 import ConTrader
+
+    instruments = ["EUR_USD", "GBP_USD", "USD_JPY", "AUD_USD", "USD_CHF"]
+    traders = [ConTrader("oanda.cfg", instrument, "1min", window = 1,
+                         units = 100000, lags = 5, model = 'logreg.pkl',
+                         p = 1, ind = 1, q = 0, SMA_S = 50, SMA_L = 200,
+                         SMA_Bol = 20, Dev = 1, Comb_Str = 2) for instrument in instruments]
+    runner = MultiRunner("oanda.cfg", traders, workers = 4)
+    runner.get_most_recent()
+    runner.stream(stop = None)
+    runner.close_positions()
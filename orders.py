@@ -0,0 +1,369 @@
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor, TimeoutError, wait
+from datetime import datetime
+from time import perf_counter
+import numpy as np
+
+
+class OrderRejected(Exception):
+    # the broker refused the order (margin, market closed, ...): it is not retried
+    pass
+
+
+class Order:
+    def __init__(self, units, going = None, clock = None):
+        self.id = uuid.uuid4().hex # client order id, the same on every attempt
+        self.units = units
+        self.going = going # "GOING LONG", ... for report_trade
+        self.clock = clock # perf_counter of the tick that asked for it (tick-to-order latency)
+        self.status = "queued" # -> sent -> filled | rejected | failed | unresolved, or cancelled by netting
+        self.attempts = 0
+        self.calls = [] # the attempts (futures)
+        self.fill = None
+        self.error = None
+
+
+class OrderManager:
+    # Sends a trader's orders from its own thread, so a slow broker never holds up the
+    # ticks or the signals. The trader only states the position it wants (target); the
+    # order sent is the difference between that and the filled position plus the orders
+    # still pending. At most one order is in flight: later targets amend the one queued
+    # behind it, so a flip and a quick flip back cancel out instead of reaching the broker.
+    # Every attempt waits at most `timeout` seconds. Failed and timed-out attempts are
+    # retried (up to `retries` times, with exponential backoff) under the same client
+    # order id, after asking the broker whether an earlier attempt went through after all.
+    # An order is given up only once none of its attempts can still fill; until then it
+    # stays pending. If that takes longer than settle_timeout (a call that never returns)
+    # the order is reported and set aside as unresolved: its units keep counting as
+    # pending, and it is settled whenever its last attempt returns, while the next orders
+    # go out. Rejections are final; the next target sends what is still missing.
+    # Brokers that cannot dedupe a client order id (idempotent = False) get one attempt.
+    # With background = False orders are sent in the caller's thread, for deterministic
+    # replays.
+    def __init__(self, broker, instrument, timeout = 10.0, retries = 3, backoff = 0.5, settle_timeout = 60.0,
+                 on_fill = None, metrics = None, background = True):
+        self.broker = broker
+        self.instrument = instrument
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.settle_timeout = settle_timeout
+        self.on_fill = on_fill # called with the filled Order, on the sending thread
+        self.metrics = metrics
+        self.background = background
+        self.position = 0 # filled units
+        self.orders = [] # every order that reached the sending stage, in order
+        self.unresolved = [] # orders whose attempts may still fill, counted as pending
+        self.stats = {"sent": 0, "filled": 0, "rejected": 0, "failed": 0, "unresolved": 0, "retries": 0,
+                      "timeouts": 0, "netted": 0}
+        self._queued = None
+        self._inflight = None
+        self._closing = False
+        self._cond = threading.Condition()
+        # attempts run here; a call that hangs past its timeout does not block the retry
+        self._calls = ThreadPoolExecutor(max_workers = retries + 1, thread_name_prefix = "order-call")
+        self._thread = None
+        if background:
+            self._thread = threading.Thread(target = self._run, name = "orders", daemon = True)
+            self._thread.start()
+
+    def pending(self):
+        return sum(order.units for order in [self._inflight, self._queued] + self.unresolved if order is not None)
+
+    def target(self, units, going = None, clock = None):
+        # ask for a position of `units`, returns at once (the queued Order, or None if the
+        # filled and pending orders already add up to it)
+        with self._cond:
+            delta = units - self.position - self.pending()
+            if delta == 0:
+                return None
+            order = self._queued
+            if order is not None: # not sent yet: amend it
+                order.units += delta
+                order.going, order.clock = going, clock
+                self.stats["netted"] += 1
+                if order.units == 0:
+                    order.status = "cancelled"
+                    self._queued = None
+                    return None
+            else:
+                order = self._queued = Order(delta, going, clock)
+                self._cond.notify_all()
+        if not self.background:
+            self._send_queued()
+        return order
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while self._queued is None and not self._closing:
+                    self._cond.wait()
+                if self._queued is None:
+                    return
+            self._send_queued()
+
+    def _send_queued(self):
+        with self._cond:
+            order, self._queued = self._queued, None
+            if order is None:
+                return
+            self._inflight = order
+            order.status = "sent"
+            self.orders.append(order)
+            self.stats["sent"] += 1
+        start = perf_counter()
+        fill = self._send(order)
+        with self._cond:
+            self._inflight = None
+            if fill is not None:
+                order.fill = fill
+                order.status = "filled"
+                self.position += order.units
+            elif order.status == "unresolved":
+                self.unresolved.append(order)
+            else:
+                order.status = "rejected" if isinstance(order.error, OrderRejected) else "failed"
+            self.stats[order.status] += 1
+            self._cond.notify_all()
+        if self.metrics is not None:
+            self.metrics.observe("order_roundtrip", perf_counter() - start)
+        if order.status == "unresolved":
+            if self.metrics is not None:
+                self.metrics.observe("order_unresolved", perf_counter() - start)
+            print("\n{} | order of {} units unresolved after {:.1f}s, its units stay pending until the broker answers".format(
+                self.instrument, order.units, perf_counter() - start))
+            # the stuck calls keep their workers, the next orders get new ones
+            self._calls.shutdown(wait = False)
+            self._calls = ThreadPoolExecutor(max_workers = self.retries + 1, thread_name_prefix = "order-call")
+            for call in order.calls:
+                call.add_done_callback(lambda call: self._settle_late(order))
+        elif fill is None:
+            print("\n{} | order of {} units {} after {} attempt(s): {}".format(
+                self.instrument, order.units, order.status, order.attempts, order.error))
+        elif self.on_fill is not None:
+            self.on_fill(order)
+
+    def _send(self, order):
+        calls = order.calls
+        attempts = self.retries + 1 if self.broker.idempotent else 1
+        try:
+            for attempt in range(attempts):
+                if attempt:
+                    self.stats["retries"] += 1
+                order.attempts += 1
+                call = self._calls.submit(self.broker.submit, self.instrument, order.units, order.id)
+                calls.append(call)
+                try:
+                    return call.result(timeout = self.timeout)
+                except OrderRejected as e:
+                    order.error = e
+                    break
+                except TimeoutError:
+                    self.stats["timeouts"] += 1
+                    order.error = "no response within {}s".format(self.timeout)
+                    call.cancel() # still waiting for a worker: it never reaches the broker
+                except Exception as e:
+                    order.error = e
+                if attempt == attempts - 1:
+                    break
+                time.sleep(self.backoff * 2 ** attempt)
+                try: # an earlier attempt may have gone through after all
+                    fill = self._resolve(order, calls)
+                except OrderRejected:
+                    return None
+                if fill is not None:
+                    return fill
+            return self._settle(order, calls)
+        finally:
+            for call in calls:
+                call.cancel()
+
+    def _resolve(self, order, calls):
+        # the fill of an attempt that answered late or of one whose response was lost, or None
+        for call in calls:
+            if call.done() and not call.cancelled() and call.exception() is None:
+                return call.result()
+        try:
+            return self.broker.lookup(order.id)
+        except OrderRejected as e:
+            order.error = e
+            raise
+        except Exception:
+            return None
+
+    def _settle(self, order, calls):
+        # no attempt answered with a fill. The order stays in flight (and its units pending)
+        # until every attempt that may still reach the broker has finished, so the next
+        # target never sends units that a late fill then doubles.
+        deadline = perf_counter() + self.settle_timeout
+        try:
+            while True:
+                running = [call for call in calls if not call.done()]
+                fill = self._resolve(order, calls)
+                if fill is not None or not running:
+                    return fill
+                left = deadline - perf_counter()
+                if left <= 0:
+                    order.status = "unresolved"
+                    return None
+                wait(running, timeout = min(self.timeout, left))
+        except OrderRejected:
+            return None
+
+    def _settle_late(self, order):
+        # an attempt of an unresolved order returned: settled once one filled or all are done
+        calls = order.calls
+        done = [call for call in calls if call.done()]
+        if len(done) < len(calls) and not any(not call.cancelled() and call.exception() is None for call in done):
+            return
+        try:
+            fill = self._resolve(order, calls)
+        except OrderRejected:
+            fill = None
+        with self._cond:
+            if order not in self.unresolved:
+                return
+            self.unresolved.remove(order)
+            self.stats["unresolved"] -= 1
+            if fill is not None:
+                order.fill = fill
+                order.status = "filled"
+                self.position += order.units
+            else:
+                order.status = "rejected" if isinstance(order.error, OrderRejected) else "failed"
+            self.stats[order.status] += 1
+        print("\n{} | unresolved order of {} units {}".format(self.instrument, order.units, order.status))
+        if fill is not None and self.on_fill is not None:
+            self.on_fill(order)
+
+    def flush(self, timeout = None):
+        # wait until no order is queued or in flight; False if timeout expired first
+        with self._cond:
+            return self._cond.wait_for(lambda: self._queued is None and self._inflight is None, timeout)
+
+    def close(self, timeout = None):
+        self.flush(timeout)
+        with self._cond:
+            self._closing = True
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join(timeout)
+        self._calls.shutdown(wait = False)
+
+
+class TraderBroker:
+    # The trader's OANDA connection (tpqoa, or ReplayAPI in a replay) as the broker of an
+    # OrderManager. Market orders carry the client order id in their clientExtensions:
+    # OANDA refuses a second order with the same id, and lookup() finds the order by it
+    # ("@id") and returns its fill. An api without the v20 context (ReplayAPI) is sent
+    # through create_order, which cannot be looked up, so its orders are not retried.
+    def __init__(self, api):
+        self.api = api
+        self.idempotent = hasattr(api, "ctx")
+
+    def submit(self, instrument, units, client_id):
+        if not self.idempotent:
+            order = self.api.create_order(instrument, units, suppress = True, ret = True)
+            if order.get("type", "ORDER_FILL") != "ORDER_FILL": # the ORDER_CANCEL transaction
+                raise OrderRejected(order.get("reason", order.get("type")))
+            return order
+        from v20.transaction import ClientExtensions
+        response = self.api.ctx.order.market(self.api.account_id, instrument = instrument, units = units,
+                                             clientExtensions = ClientExtensions(id = client_id))
+        body = response.body
+        if "orderFillTransaction" in body:
+            return body["orderFillTransaction"].dict()
+        reject = body.get("orderCancelTransaction") or body.get("orderRejectTransaction")
+        if reject is not None and reject.reason == "CLIENT_ORDER_ID_ALREADY_EXISTS":
+            return self.lookup(client_id) # an earlier attempt reached OANDA
+        if reject is not None or response.status == 400:
+            raise OrderRejected(reject.reason if reject is not None else body.get("errorMessage"))
+        raise ConnectionError("order request failed ({}): {}".format(response.status, body.get("errorMessage")))
+
+    def lookup(self, client_id):
+        # the fill of the order with this client id, None if OANDA has no such order (yet)
+        if not self.idempotent:
+            return None
+        response = self.api.ctx.order.get(self.api.account_id, "@" + client_id)
+        if response.status == 404:
+            return None
+        if response.status != 200:
+            raise ConnectionError("order lookup failed ({}): {}".format(response.status, response.body.get("errorMessage")))
+        order = response.body["order"]
+        if order.state == "FILLED":
+            return self.api.ctx.transaction.get(self.api.account_id, order.fillingTransactionID).body["transaction"].dict()
+        if order.state == "CANCELLED":
+            cancel = self.api.ctx.transaction.get(self.api.account_id, order.cancellingTransactionID).body["transaction"]
+            raise OrderRejected(cancel.reason)
+        return None
+
+
+class MockBroker:
+    # Local broker for trying the order path without OANDA: every call takes a random
+    # latency (latency +- jitter seconds, slow_rate of them slow_latency), reject_rate of
+    # the orders are rejected, error_rate fail before reaching the "broker" and lost_rate
+    # are filled but the response is lost on the way back. Like OANDA with a client order
+    # id, the same id is never filled twice. Fills are at price(), with the realized P&L
+    # of the closed units as "pl".
+    idempotent = True
+
+    def __init__(self, latency = 0.05, jitter = 0.02, reject_rate = 0.0, error_rate = 0.0, lost_rate = 0.0,
+                 slow_rate = 0.0, slow_latency = 30.0, price = None, seed = None):
+        self.latency = latency
+        self.jitter = jitter
+        self.reject_rate = reject_rate
+        self.error_rate = error_rate
+        self.lost_rate = lost_rate
+        self.slow_rate = slow_rate
+        self.slow_latency = slow_latency
+        self.price = price or (lambda: 1.1)
+        self.rng = np.random.default_rng(seed)
+        self.calls = 0
+        self.fills = {} # client id -> fill
+        self.units = 0
+        self._avg_price = 0.0
+        self._lock = threading.Lock()
+
+    def submit(self, instrument, units, client_id):
+        with self._lock:
+            self.calls += 1
+            u = self.rng.random()
+            delay = self.slow_latency if self.rng.random() < self.slow_rate else \
+                max(self.rng.normal(self.latency, self.jitter), 0)
+        time.sleep(delay)
+        with self._lock:
+            if client_id in self.fills: # a retry of an order that went through
+                return self.fills[client_id]
+            if u < self.reject_rate:
+                raise OrderRejected("INSUFFICIENT_MARGIN")
+            if u < self.reject_rate + self.error_rate:
+                raise ConnectionError("connection reset")
+            fill = self._fill(instrument, units, client_id)
+            if u < self.reject_rate + self.error_rate + self.lost_rate:
+                raise ConnectionError("response lost")
+            return fill
+
+    def lookup(self, client_id):
+        with self._lock:
+            return self.fills.get(client_id)
+
+    def _fill(self, instrument, units, client_id):
+        price = self.price()
+        pl = 0.0
+        if self.units and np.sign(units) != np.sign(self.units):
+            pl = min(abs(units), abs(self.units)) * np.sign(self.units) * (price - self._avg_price)
+        new = self.units + units
+        if new == 0:
+            self._avg_price = 0.0
+        elif np.sign(new) != np.sign(self.units):
+            self._avg_price = price
+        elif abs(new) > abs(self.units):
+            self._avg_price = (self._avg_price * abs(self.units) + price * abs(units)) / abs(new)
+        self.units = new
+        fill = {"id": str(len(self.fills) + 1), "time": datetime.utcnow().isoformat() + "Z", "instrument": instrument,
+                "units": str(units), "price": str(price), "pl": str(round(pl, 4)), "type": "ORDER_FILL",
+                "clientOrderID": client_id}
+        self.fills[client_id] = fill
+        return fill
@@ -0,0 +1,125 @@
+import threading
+from time import perf_counter
+from collections import deque
+import pandas as pd
+from bars import BarBuilder
+
+
+class LatestSlot:
+    # Bounded queue of size one: put() replaces an item that has not been taken yet,
+    # so a slow consumer always gets the newest item and never a backlog.
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._item = None
+        self._full = False
+        self.replaced = 0
+
+    def put(self, item):
+        with self._cond:
+            if self._full:
+                self.replaced += 1
+            self._item = item
+            self._full = True
+            self._cond.notify()
+
+    def get(self):
+        with self._cond:
+            while not self._full:
+                self._cond.wait()
+            self._full = False
+            return self._item
+
+
+class BarPipeline:
+    # Staged version of on_success:
+    #   tick ingest (stream thread) -> bar close -> signal compute -> order dispatch
+    # The stream thread only builds the current bar with its own BarBuilder. Finished bars
+    # are handed to the compute thread, which owns the trader's bar history and runs
+    # resample_and_join and define_strategy; execute_trades runs on a dispatch thread.
+    # Ticks keep being consumed during long computes. Finished bars are never dropped,
+    # but a signal whose bar has already been superseded by a newer finished bar is.
+    def __init__(self, trader):
+        self.trader = trader
+        self.closed_bars = deque(maxlen = trader.bars.history.capacity)
+        self.compute_slot = LatestSlot()
+        self.order_slot = LatestSlot()
+        self.stale_signals = 0
+        self.lock = threading.Lock() # compute and dispatch never touch the trader at the same time
+        self.builder = None
+        self._threads = []
+
+    def start(self):
+        # continue from the last bar of the warm-up history
+        history = self.trader.bars.history
+        self.builder = BarBuilder(self.trader.bar_length, capacity = history.capacity)
+        self.builder.history.append(int(history.times.last()), {col: history.last(col) for col in BarBuilder.COLUMNS})
+        self._threads = [threading.Thread(target = self._compute, name = "compute", daemon = True),
+                         threading.Thread(target = self._dispatch, name = "dispatch", daemon = True)]
+        for thread in self._threads:
+            thread.start()
+
+    def stop(self):
+        self.compute_slot.put(None) # the compute thread passes the stop on to dispatch
+        for thread in self._threads:
+            thread.join()
+
+    def stream(self, stop = None):
+        self.start()
+        self.trader.on_success = self.on_tick # tpqoa.stream_data delivers the ticks here
+        try:
+            self.trader.stream_data(self.trader.instrument, stop = stop)
+        finally:
+            del self.trader.on_success
+            self.stop()
+
+    def on_tick(self, time, bid, ask):
+        clock = perf_counter()
+        print(self.trader.ticks, end = " ", flush = True)
+        recent_tick = pd.to_datetime(time)
+        price = (ask + bid)/2
+        closed = self.builder.update(recent_tick, price)
+        if closed:
+            history = self.builder.history
+            self.closed_bars.append((history.times.view(closed).copy(),
+                                     {col: history.column(col, closed).copy() for col in BarBuilder.COLUMNS}))
+            self.compute_slot.put((recent_tick, price, clock))
+        self.trader.metrics.observe("on_tick", perf_counter() - clock)
+
+    def _drain(self):
+        while self.closed_bars:
+            times, values = self.closed_bars.popleft()
+            self.trader.bars.history.extend(pd.to_datetime(times, utc = True), values)
+
+    def _compute(self):
+        trader = self.trader
+        while True:
+            tick = self.compute_slot.get()
+            with self.lock:
+                self._drain()
+                if tick is None: # keep the finished bars, but no new signal while stopping
+                    self.order_slot.put(None)
+                    return
+                recent_tick, price, clock = tick
+                trader.tick_data.append(recent_tick, price)
+                try:
+                    trader.resample_and_join()
+                    trader.define_strategy()
+                except Exception as e:
+                    print("\nsignal compute failed: {}".format(e))
+                    continue
+            if self.closed_bars: # a newer bar finished while computing
+                self.stale_signals += 1
+                continue
+            self.order_slot.put((trader.last_bar, clock))
+
+    def _dispatch(self):
+        while True:
+            item = self.order_slot.get()
+            if item is None:
+                return
+            bar, self.trader.tick_clock = item # tick-to-order latency includes the time spent queued
+            try:
+                with self.lock:
+                    self.trader.execute_trades() # also writes the snapshot, if the trader keeps one
+            except Exception as e:
+                print("\norder dispatch for bar {} failed: {}".format(bar, e))
@@ -0,0 +1,158 @@
+import time
+import tempfile
+import numpy as np
+import pandas as pd
+import tpqoa
+from journal import SQLiteBackend
+
+
+def synthetic_market(start, session = "1h", history_days = 5, tick_interval = 2.0, spread = 0.00008,
+                     vol = 2e-5, price = 1.1, seed = 0):
+    # Reproducible EUR_USD-like data: bid/ask ticks for the session after start (what the
+    # stream delivers) and S5 mid candles from history_days before start to the end of the
+    # session (what get_history serves up to the replay clock), one random walk throughout.
+    # Ticks arrive with exponential gaps of tick_interval seconds on average.
+    rng = np.random.default_rng(seed)
+    start = pd.Timestamp(start)
+    start = start.tz_localize("UTC") if start.tz is None else start.tz_convert("UTC")
+    index = pd.date_range(end = start - pd.Timedelta("5s"), periods = int(pd.Timedelta(days = history_days) / pd.Timedelta("5s")),
+                          freq = "5s")
+    walk = price + rng.normal(0, vol, (len(index), 4)).cumsum(axis = None).reshape(-1, 4)
+    candles = pd.DataFrame({"o": walk[:, 0], "h": walk.max(axis = 1), "l": walk.min(axis = 1), "c": walk[:, 3],
+                            "volume": rng.integers(1, 20, len(index)), "complete": True}, index = index)
+    n = int(pd.to_timedelta(session).total_seconds() / tick_interval)
+    offsets = np.cumsum(rng.exponential(tick_interval, n))
+    offsets = offsets[offsets < pd.to_timedelta(session).total_seconds()]
+    mid = walk[-1, 3] + rng.normal(0, vol, len(offsets)).cumsum()
+    ticks = pd.DataFrame({"bid": mid - spread / 2, "ask": mid + spread / 2},
+                         index = start + pd.to_timedelta(offsets, unit = "s"))
+    live = pd.Series(mid, index = ticks.index).resample("5s")
+    live = pd.DataFrame({"o": live.first(), "h": live.max(), "l": live.min(), "c": live.last(),
+                         "volume": live.count(), "complete": True}).dropna()
+    return pd.concat([candles, live]), ticks
+
+
+def load_ticks(path):
+    # recorded ticks, a csv with time, bid and ask columns
+    ticks = pd.read_csv(path, index_col = "time", usecols = ["time", "bid", "ask"])
+    ticks.index = pd.to_datetime(ticks.index, utc = True)
+    return ticks.sort_index()
+
+
+class ReplayAPI(tpqoa.tpqoa):
+    # Local stand-in for the OANDA side of tpqoa: get_history serves the given S5 candles,
+    # stream_data feeds the given ticks to on_success (at full speed, or paced, where
+    # pace = 1 is real time and pace = 60 a minute of market per second) and create_order
+    # fills at the current bid/ask, with the realized P&L of the closed units as "pl".
+    # The trader clock (utcnow) follows the ticks, so a replay gives the same bars,
+    # signals and orders every time.
+    def __init__(self, conf_file = None):
+        self.ticks = 0
+        self.stop_stream = False
+        self.orders = []
+        self.pace = None
+        self._candles = None
+        self._times = np.array([], dtype = "M8[ns]")
+        self._bids = self._asks = np.array([])
+        self._clock = None
+        self._bid = self._ask = None
+        self._units = 0
+        self._avg_price = 0.0
+
+    def load_replay(self, candles, ticks, pace = None):
+        self._candles = candles
+        self._times = ticks.index.tz_convert("UTC").tz_localize(None).values.astype("M8[ns]")
+        self._bids = ticks["bid"].to_numpy(dtype = float)
+        self._asks = ticks["ask"].to_numpy(dtype = float)
+        self._clock = self._times[0] if len(self._times) else candles.index[-1].tz_localize(None).to_datetime64()
+        self.pace = pace
+        self.tick_seconds = np.full(len(self._times), np.nan) # on_success wall time per tick
+        self.bar_ticks = np.zeros(len(self._times), dtype = bool) # ticks that closed a bar
+
+    def utcnow(self):
+        return pd.Timestamp(self._clock).floor("us").to_pydatetime()
+
+    def get_history(self, instrument, start, end, granularity, price, localize = True):
+        clock = pd.Timestamp(self._clock, tz = "UTC")
+        start, end = pd.Timestamp(start, tz = "UTC"), min(pd.Timestamp(end, tz = "UTC"), clock)
+        candles = self._candles
+        df = candles[(candles.index >= start) & (candles.index <= end)].copy()
+        step = pd.to_timedelta({"S": "{}s", "M": "{}min", "H": "{}h"}[granularity[0]].format(granularity[1:]))
+        df["complete"] = df.index + step <= clock # the candle still forming at the replay clock
+        df.index.name = "time"
+        if localize:
+            df.index = df.index.tz_localize(None)
+        return df
+
+    def stream_data(self, instrument, stop = None, ret = False):
+        times = np.datetime_as_string(self._times) # OANDA style, nanoseconds
+        wall = time.perf_counter()
+        first = self._times[min(self.ticks, len(self._times) - 1)] if len(self._times) else None
+        for i in range(self.ticks, len(self._times)):
+            if self.pace:
+                delay = (self._times[i] - first) / np.timedelta64(1, "s") / self.pace - (time.perf_counter() - wall)
+                if delay > 0:
+                    time.sleep(delay)
+            self._clock, self._bid, self._ask = self._times[i], self._bids[i], self._asks[i]
+            self.ticks += 1
+            bar = self.last_bar
+            t0 = time.perf_counter()
+            self.on_success(times[i] + "Z", self._bid, self._ask)
+            self.tick_seconds[i] = time.perf_counter() - t0
+            self.bar_ticks[i] = self.last_bar is not bar
+            if (stop is not None and self.ticks >= stop) or self.stop_stream:
+                break
+
+    def create_order(self, instrument, units, price = None, sl_distance = None, tsl_distance = None,
+                     tp_price = None, comment = None, suppress = False, ret = False):
+        fill = self._ask if units > 0 else self._bid
+        pl = 0.0
+        if self._units and np.sign(units) != np.sign(self._units):
+            closed = min(abs(units), abs(self._units)) * np.sign(self._units)
+            pl = closed * (fill - self._avg_price)
+        new = self._units + units
+        if new == 0:
+            self._avg_price = 0.0
+        elif np.sign(new) != np.sign(self._units): # opened, or flipped through flat
+            self._avg_price = fill
+        elif abs(new) > abs(self._units):
+            self._avg_price = (self._avg_price * abs(self._units) + fill * abs(units)) / abs(new)
+        self._units = new
+        order = {"id": str(len(self.orders) + 1), "time": np.datetime_as_string(self._clock) + "Z",
+                 "instrument": instrument, "units": str(units), "price": str(fill), "pl": str(round(pl, 4)),
+                 "type": "ORDER_FILL"}
+        self.orders.append(order)
+        if not suppress:
+            print("\n\n", order, "\n")
+        if ret:
+            return order
+
+
+def replay_trader(trader_class, candles, ticks, pace = None, conf_file = "replay", **kwargs):
+    # trader_class (ConTrader, DNNTrader2, ...) running against ReplayAPI instead of OANDA,
+    # with a throwaway candle cache and an in-memory trade journal unless given. Orders are
+    # sent and snapshots written in the foreground, so they fill at the tick that asked for
+    # them and a snapshot holds the bar it was taken at.
+    replay_class = type("Replay" + trader_class.__name__, (trader_class, ReplayAPI), {"utcnow": ReplayAPI.utcnow})
+    kwargs.setdefault("cache_dir", tempfile.mkdtemp(prefix = "replay-history-"))
+    kwargs.setdefault("journal_backend", SQLiteBackend(":memory:"))
+    kwargs.setdefault("order_background", False)
+    kwargs.setdefault("snapshot_background", False)
+    trader = replay_class(conf_file, **kwargs)
+    trader.load_replay(candles, ticks, pace)
+    return trader
+
+
+if __name__ == "__main__":
+
+    from Multi_Trader_2 import ConTrader
+
+    candles, ticks = synthetic_market("2024-01-03 12:00", session = "2h", seed = 1)
+    trader = replay_trader(ConTrader, candles, ticks, instrument = "EUR_USD", bar_length = "1min",
+                           window = 1, units = 100000, lags = 5, model = "logreg.pkl", p = 1, ind = 1, q = 0,
+                           SMA_S = 50, SMA_L = 200, SMA_Bol = 20, Dev = 1, Comb_Str = 2, arima_background = False)
+    trader.get_most_recent()
+    trader.stream_data(trader.instrument)
+    print("\n{} ticks | {} orders | Cum P&L = {:.2f}".format(trader.ticks, len(trader.orders), sum(trader.profits)))
+    trader.metrics.report()
+    trader.journal.close()
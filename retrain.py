@@ -0,0 +1,205 @@
+import os
+import pickle
+import time
+from concurrent.futures import Future, ProcessPoolExecutor
+from multiprocessing import get_context
+import numpy as np
+import pandas as pd
+from inference import lag_matrix
+from models import LazyModel, load_model, export_model
+
+
+def _split(X, y, holdout):
+    # chronological: the newest `holdout` fraction of the rows validates, the rest trains
+    cut = len(X) - max(int(len(X) * holdout), 1)
+    return X[:cut], y[:cut], X[cut:], y[cut:]
+
+
+def portable(model):
+    # what the fitting process can score the traded model from: its file, or the object
+    # itself if it pickles (None otherwise, e.g. a Keras model handed over in memory)
+    if isinstance(model.source, str):
+        return model.source
+    try:
+        pickle.dumps(model.source)
+    except Exception:
+        return None
+    return model.source
+
+
+def _load(source):
+    # the model currently traded, to be scored on the same held-out bars (None if it
+    # cannot be loaded in this process, e.g. a .tflite file without a TFLite runtime)
+    try:
+        return load_model(source) if isinstance(source, str) else source
+    except Exception:
+        return None
+
+
+def _accuracy(model, X, y, proba = False):
+    # share of held-out bars whose direction (-1 / 1) the model got right
+    if model is None:
+        return np.nan
+    pred = np.asarray(model.predict(X), dtype = float).reshape(len(X), -1)[:, 0]
+    if proba:
+        pred = np.where(pred > 0.5, 1, -1)
+    return float((pred == y).mean())
+
+
+def _path(model_dir, tag, name, ext):
+    os.makedirs(model_dir, exist_ok = True)
+    return os.path.join(model_dir, "{}_{}_{}{}".format(tag, name, pd.Timestamp.now("UTC").strftime("%Y%m%d_%H%M%S_%f"), ext))
+
+
+def fit_direction(returns, cols, current, holdout = 0.2, model_dir = "retrained", tag = "model"):
+    # ConTrader's ML model (logreg.pkl): the direction of a bar (-1, 0, 1) from the log
+    # returns of the bars before it, refitted on `returns` and exported to .npz
+    from sklearn.linear_model import LogisticRegression
+    t0 = time.perf_counter()
+    lags = len(cols)
+    X = lag_matrix([returns], lags, rows = len(returns))
+    y = np.sign(returns[lags:])
+    ok = ~np.isnan(X).any(axis = 1) & ~np.isnan(y)
+    X, y = pd.DataFrame(X[ok], columns = cols), y[ok]
+    X_train, y_train, X_test, y_test = _split(X, y, holdout)
+    lr = LogisticRegression(C = 1e6, max_iter = 100000).fit(X_train, y_train)
+    path = export_model(lr, _path(model_dir, tag, "logreg", ".npz"))
+    scores = {"model": (_accuracy(load_model(path), X_test, y_test), _accuracy(_load(current["model"]), X_test, y_test))}
+    return {"models": {"model": path}, "params": None, "scores": scores, "rows": len(X),
+            "seconds": time.perf_counter() - t0}
+
+
+def _fit_dnn(X, y, epochs, seed):
+    # same layout as DNN_model_3: two hidden layers with dropout, a sigmoid "up" output
+    import tensorflow as tf
+    from tensorflow import keras
+    tf.random.set_seed(seed)
+    model = keras.Sequential([keras.layers.Input((X.shape[1],)),
+                              keras.layers.Dense(100, activation = "relu"), keras.layers.Dropout(0.3),
+                              keras.layers.Dense(100, activation = "relu"), keras.layers.Dropout(0.3),
+                              keras.layers.Dense(1, activation = "sigmoid")])
+    model.compile(optimizer = keras.optimizers.Adam(learning_rate = 0.0001), loss = "binary_crossentropy")
+    up = (y > 0).astype(float)
+    weights = {0: len(up) / (2 * max((up == 0).sum(), 1)), 1: len(up) / (2 * max((up == 1).sum(), 1))}
+    model.fit(np.asarray(X, dtype = np.float32), up, epochs = epochs, class_weight = weights,
+              shuffle = False, verbose = 0)
+    return model
+
+
+def fit_ensemble(features, names, cols, current, mu, std, holdout = 0.2, epochs = 25, seed = 100,
+                 model_dir = "retrained", tag = "model"):
+    # DNNTrader2's models on the lagged features: the standardization (mu / std of the
+    # training rows), the DNN, the logistic regression and the random forest. Without
+    # TensorFlow the DNN and its mu / std are kept and LR / RF are refitted on them.
+    from sklearn.linear_model import LogisticRegression
+    from sklearn.ensemble import RandomForestClassifier
+    t0 = time.perf_counter()
+    lags = len(cols) // len(names)
+    returns = features["returns"]
+    X = lag_matrix([features[f] for f in names], lags, rows = len(returns))
+    y = np.where(returns[lags:] > 0, 1, -1)
+    ok = ~np.isnan(X).any(axis = 1) & ~np.isnan(returns[lags:])
+    X, y = X[ok], y[ok]
+    X_train, y_train, X_test, y_test = _split(X, y, holdout)
+    try:
+        import tensorflow
+    except ImportError:
+        epochs = 0
+    old_mu, old_std = np.asarray(mu[cols], dtype = float), np.asarray(std[cols], dtype = float)
+    new_mu, new_std = (X_train.mean(axis = 0), X_train.std(axis = 0)) if epochs else (old_mu, old_std)
+    frame = lambda X, mu, std: pd.DataFrame((X - mu) / std, columns = cols)
+    train, test, old_test = frame(X_train, new_mu, new_std), frame(X_test, new_mu, new_std), frame(X_test, old_mu, old_std)
+
+    paths, scores = {}, {}
+    if epochs:
+        dnn = _fit_dnn(train, y_train, epochs, seed)
+        paths["DNN_model"] = _path(model_dir, tag, "DNN", ".keras")
+        dnn.save(paths["DNN_model"])
+        scores["DNN_model"] = (_accuracy(load_model(paths["DNN_model"]), test, y_test, proba = True),
+                               _accuracy(_load(current["DNN_model"]), old_test, y_test, proba = True))
+    lr = LogisticRegression(C = 1e6, max_iter = 100000).fit(train, y_train)
+    rf = RandomForestClassifier(n_estimators = 100, random_state = seed, n_jobs = -1).fit(train, y_train)
+    for name, model, label in [("LR_model", lr, "LR"), ("RF_model", rf, "RF")]:
+        paths[name] = export_model(model, _path(model_dir, tag, label, ".npz"))
+        scores[name] = (_accuracy(load_model(paths[name]), test, y_test), _accuracy(_load(current[name]), old_test, y_test))
+    params = {"mu": pd.Series(new_mu, index = cols), "std": pd.Series(new_std, index = cols)} if epochs else None
+    return {"models": paths, "params": params, "scores": scores, "rows": len(X), "seconds": time.perf_counter() - t0}
+
+
+class Retrainer:
+    # Refits a trader's models every `every` bars on a separate process (fit is one of the
+    # functions above, called with the training window the trader hands to update()).
+    # The refitted models are scored on the newest `holdout` share of the window, which
+    # they were not trained on, next to the models currently traded. They are accepted only
+    # if none of them does worse than its predecessor by more than `tolerance`, then load
+    # in the background (LazyModel) and poll() hands them over once all of them are loaded.
+    # The trader swaps them in between two bars on its compute thread, so every signal
+    # comes from one consistent set of models and no bar waits for a fit or a load.
+    # With background = False the fit runs in the foreground, for deterministic replays.
+    def __init__(self, fit, every = 1440, holdout = 0.2, tolerance = 0.0, background = True, metrics = None, **fit_kwargs):
+        self.fit = fit
+        self.every = every
+        self.holdout = holdout
+        self.tolerance = tolerance
+        self.background = background
+        self.metrics = metrics
+        self.fit_kwargs = fit_kwargs
+        self.fits = 0
+        self.swaps = 0
+        self.last_result = None
+        self._bars = 0
+        self._job = None
+        self._loading = None
+        self._pool = None
+
+    def update(self, new_bars, data):
+        # data() returns the keyword arguments of fit (copies of the training window), it is
+        # only called when a refit is due
+        self._bars += new_bars
+        if self._bars < self.every or self._job is not None or self._loading is not None:
+            return
+        self._bars = 0
+        kwargs = dict(data(), holdout = self.holdout, **self.fit_kwargs)
+        if self.background:
+            if self._pool is None: # spawn: no copy of the trader's threads and sockets
+                self._pool = ProcessPoolExecutor(max_workers = 1, mp_context = get_context("spawn"))
+            self._job = self._pool.submit(self.fit, **kwargs)
+        else:
+            self._job = Future()
+            self._job.set_result(self.fit(**kwargs))
+
+    def accepted(self, scores):
+        return all(np.isnan(old) or new >= old - self.tolerance for new, old in scores.values())
+
+    def poll(self):
+        # (models, params) to swap in, or None; never waits for a fit or a load in the background
+        if self._job is not None and self._job.done():
+            job, self._job = self._job, None
+            try:
+                result = job.result()
+            except Exception as e: # keep trading with the current models
+                print("\nRetraining failed: {}".format(e))
+                return None
+            self.fits += 1
+            self.last_result = result
+            if self.metrics is not None:
+                self.metrics.observe("retrain", result["seconds"])
+            accepted = self.accepted(result["scores"])
+            if accepted:
+                self._loading = ({name: LazyModel(path) for name, path in result["models"].items()}, result["params"])
+            print("\n" + self.report(accepted))
+        if self._loading is not None and (not self.background or all(m.ready() for m in self._loading[0].values())):
+            swap, self._loading = self._loading, None
+            self.swaps += 1
+            return swap
+        return None
+
+    def report(self, accepted = True):
+        r = self.last_result
+        scores = " | ".join("{} {:.3f} (was {:.3f})".format(name, new, old) for name, (new, old) in r["scores"].items())
+        return "Retrained on {} bars in {:.1f}s | held-out accuracy: {} | {}".format(
+            r["rows"], r["seconds"], scores, "swapping in" if accepted else "rejected")
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait = False, cancel_futures = True)
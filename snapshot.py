@@ -0,0 +1,95 @@
+import os
+import json
+import threading
+from itertools import count
+import numpy as np
+from pipeline import LatestSlot
+
+
+class Snapshot:
+    # Crash-safe trader state in one uncompressed .npz file: every FrameBuffer is stored
+    # column by column ("<buffer>/<column>", plus "<buffer>/times" in UTC ns) next to a
+    # small JSON document of scalars (position, P&L, model parameters). save() writes a
+    # temporary file and renames it over the old one, so a crash leaves either the
+    # previous or the new snapshot, never a mix.
+    # A buffer can be given as (FrameBuffer, n) to store only its last n rows, what the
+    # trader needs to resume. maybe_save() runs every `every` calls (or when forced) and,
+    # with background = True, only copies the rows and hands them to a writer thread,
+    # which writes and fsyncs the newest state; a state older than the one on disk is
+    # never written.
+    def __init__(self, path, every = 5, background = True):
+        self.path = path
+        self.every = every # save on every n-th call of maybe_save
+        self.saves = 0
+        self._calls = 0
+        self._seq = count(1)
+        self._written = 0
+        self._lock = threading.Lock()
+        self._slot = None
+        if background:
+            self._slot = LatestSlot()
+            threading.Thread(target = self._run, name = "snapshot", daemon = True).start()
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def _arrays(self, buffers, meta, copy):
+        arrays = {"meta": np.array(json.dumps(meta))}
+        for name, buf in buffers.items():
+            buf, n = buf if isinstance(buf, tuple) else (buf, None)
+            arrays[name + "/times"] = buf.times.view(n)
+            for col in buf.columns:
+                arrays[name + "/" + col] = buf.column(col, n)
+        if copy: # the buffers keep moving while the writer thread saves
+            arrays = {key: value.copy() for key, value in arrays.items()}
+        return next(self._seq), arrays
+
+    def _write(self, seq, arrays):
+        with self._lock:
+            if seq <= self._written:
+                return
+            with open(self.path + ".tmp", "wb") as f:
+                np.savez(f, **arrays)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(self.path + ".tmp", self.path)
+            self._written = seq
+            self.saves += 1
+
+    def save(self, buffers, meta):
+        # in the caller's thread (e.g. at shutdown)
+        self._write(*self._arrays(buffers, meta, copy = False))
+
+    def maybe_save(self, buffers, meta, force = False):
+        self._calls += 1
+        if not force and self._calls % self.every:
+            return
+        if self._slot is None:
+            self.save(buffers, meta)
+        else:
+            self._slot.put(self._arrays(buffers, meta, copy = True))
+
+    def _run(self):
+        while True:
+            seq, arrays = self._slot.get()
+            try:
+                self._write(seq, arrays)
+            except Exception as e:
+                print("\nSnapshot {} not written: {}".format(self.path, e))
+    def load(self):
+        # (buffers, meta) with buffers as name -> (times, {column: values}), or None
+        if not self.exists():
+            return None
+        with np.load(self.path, allow_pickle = False) as f:
+            meta = json.loads(str(f["meta"]))
+            buffers = {}
+            for key in f.files:
+                if key == "meta":
+                    continue
+                name, col = key.rsplit("/", 1)
+                times, values = buffers.setdefault(name, (None, {}))
+                if col == "times":
+                    buffers[name] = (f[key], values)
+                else:
+                    values[col] = f[key]
+        return buffers, meta
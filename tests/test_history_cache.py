@@ -0,0 +1,53 @@
+import numpy as np
+import pandas as pd
+from history_cache import HistoryCache
+
+
+class FakeAPI:
+    # tpqoa.get_history(..., localize = False) over fixed S5 candles; the candle at `forming`
+    # is still incomplete
+    def __init__(self, candles, forming = None):
+        self.candles = candles
+        self.forming = forming
+        self.calls = []
+
+    def get_history(self, instrument, start, end, granularity, price, localize):
+        start, end = pd.Timestamp(start, tz = "UTC"), pd.Timestamp(end, tz = "UTC")
+        self.calls.append((start, end))
+        df = self.candles.loc[start:end].copy()
+        df["complete"] = df.index != self.forming
+        return df
+
+
+def candles(start = "2024-01-01", n = 2000, seed = 0):
+    index = pd.date_range(start, periods = n, freq = "5s", tz = "UTC")
+    c = 1.1 + np.random.default_rng(seed).normal(0, 1e-5, n).cumsum()
+    return pd.DataFrame({"o": c, "h": c, "l": c, "c": c, "volume": np.ones(n, dtype = int)}, index = index)
+
+
+def test_only_the_missing_tail_is_downloaded(tmp_path):
+    data = candles()
+    api, cache = FakeAPI(data), HistoryCache(str(tmp_path))
+    first = cache.get_history(api, "EUR_USD", data.index[0], data.index[999], "S5")
+    second = cache.get_history(api, "EUR_USD", data.index[0], data.index[-1], "S5")
+    assert len(first) == 1000 and len(second) == len(data)
+    assert api.calls[-1][0] == data.index[999]
+    np.testing.assert_array_equal(second["c"].values, data["c"].values)
+
+
+def test_tail_without_forming_candle(tmp_path):
+    # every candle of the tail is complete: nothing pending to append (used to fail
+    # comparing an empty tz-naive index with the UTC cache index)
+    data = candles()
+    api, cache = FakeAPI(data), HistoryCache(str(tmp_path))
+    cache.get_history(api, "EUR_USD", data.index[0], data.index[999], "S5")
+    df = cache.get_history(api, "EUR_USD", data.index[0], data.index[-1], "S5")
+    assert df.index.tz is not None and df.index[-1] == data.index[-1]
+
+
+def test_forming_candle_is_served_but_not_stored(tmp_path):
+    data = candles()
+    api, cache = FakeAPI(data, forming = data.index[-1]), HistoryCache(str(tmp_path))
+    df = cache.get_history(api, "EUR_USD", data.index[0], data.index[-1], "S5")
+    assert df.index[-1] == data.index[-1]
+    assert cache.last_time("EUR_USD", "S5") == data.index[-2]
@@ -0,0 +1,86 @@
+import numpy as np
+import pandas as pd
+import pytest
+from indicators import ConIndicators, DNNFeatures
+
+
+def prices(n = 1500, seed = 0):
+    rng = np.random.default_rng(seed)
+    return pd.Series(1.1 + rng.normal(0, 5e-4, n).cumsum())
+
+
+def run(engine, price):
+    # the engine fed one bar at a time, as the traders do
+    return pd.DataFrame([engine.update(float(p)) for p in price], index = price.index)
+
+
+def assert_parity(got, expected, rtol = 1e-12, atol = 1e-12):
+    # same NaN warm-up, same values afterwards
+    np.testing.assert_array_equal(got.isna().values, expected.isna().values)
+    ok = expected.notna().values
+    np.testing.assert_allclose(got.values[ok], expected.values[ok], rtol = rtol, atol = atol)
+
+
+@pytest.mark.parametrize("window, SMA_S, SMA_L, SMA_Bol, Dev", [(1, 50, 200, 20, 1), (3, 5, 12, 7, 2)])
+def test_con_indicators_match_pandas(window, SMA_S, SMA_L, SMA_Bol, Dev):
+    price = prices()
+    got = run(ConIndicators(window, SMA_S, SMA_L, SMA_Bol, Dev), price)
+
+    # ConTrader.define_strategy before the incremental engine
+    returns = np.log(price / price.shift())
+    assert_parity(got["Contrarian_returns"], returns)
+    assert_parity(got["Contrarian_position"], -np.sign(returns.rolling(window).mean()))
+    sma_s, sma_l = price.rolling(SMA_S).mean(), price.rolling(SMA_L).mean()
+    assert_parity(got["SMA_S"], sma_s)
+    assert_parity(got["SMA_L"], sma_l)
+    mean, std = price.rolling(SMA_Bol).mean(), price.rolling(SMA_Bol).std()
+    assert_parity(got["SMA_Bol"], mean)
+    assert_parity(got["Lower_Bol"], mean - std * Dev)
+    assert_parity(got["Upper_Bol"], mean + std * Dev)
+    assert_parity(got["distance"], price - mean)
+
+    # the pandas version fills the warm-up with -1 / 0 and the rows are dropped later;
+    # the engine leaves them NaN
+    ready = sma_l.notna()
+    np.testing.assert_array_equal(got["SMA_position"].isna(), ~ready)
+    np.testing.assert_array_equal(got["SMA_position"][ready], np.where(sma_s > sma_l, 1.0, -1.0)[ready])
+
+
+@pytest.mark.parametrize("Dev", [1, 2])
+def test_bollinger_position_carry(Dev):
+    price = prices(seed = 1)
+    SMA_Bol = 20
+    got = run(ConIndicators(1, 5, 10, SMA_Bol, Dev), price)["Bol_position"]
+
+    df = pd.DataFrame({"price": price, "SMA_Bol": price.rolling(SMA_Bol).mean()})
+    std = price.rolling(SMA_Bol).std()
+    df["Lower_Bol"], df["Upper_Bol"] = df.SMA_Bol - std * Dev, df.SMA_Bol + std * Dev
+    df["distance"] = df.price - df.SMA_Bol
+    pos = np.where(df.price < df.Lower_Bol, 1, np.nan)
+    pos = np.where(df.price > df.Upper_Bol, -1, pos)
+    pos = np.where(df.distance * df.distance.shift(1) < 0, 0, pos)
+    expected = pd.Series(pos).ffill().fillna(0)
+
+    ready = df.distance.notna()
+    np.testing.assert_array_equal(got.isna(), ~ready)
+    np.testing.assert_array_equal(got[ready], expected[ready])
+    # long, short and neutral all occur, so the carry between band touches is exercised
+    assert set(got[ready]) == {-1.0, 0.0, 1.0}
+
+
+@pytest.mark.parametrize("window", [5, 50])
+def test_dnn_features_match_pandas(window):
+    price = prices(seed = 2)
+    got = run(DNNFeatures(window), price)
+
+    # DNNTrader2.define_strategy before the incremental engine
+    returns = np.log(price / price.shift())
+    mean = price.rolling(window).mean()
+    assert_parity(got["returns"], returns)
+    assert_parity(got["dir"], pd.Series(np.where(returns > 0, 1.0, -1.0)))
+    assert_parity(got["sma"], mean - price.rolling(150).mean())
+    assert_parity(got["boll"], (price - mean) / price.rolling(window).std(), rtol = 1e-8, atol = 1e-8)
+    assert_parity(got["min"], price.rolling(window).min() / price - 1)
+    assert_parity(got["max"], price.rolling(window).max() / price - 1)
+    assert_parity(got["mom"], returns.rolling(3).mean())
+    assert_parity(got["vol"], returns.rolling(window).std())
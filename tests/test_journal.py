@@ -0,0 +1,68 @@
+import sqlite3
+from datetime import datetime
+from journal import TradeJournal, SQLiteBackend
+
+
+def rows(path, table):
+    with sqlite3.connect(path) as conn:
+        return conn.execute(f"SELECT Units FROM {table} ORDER BY Units").fetchall()
+
+
+def test_bad_row_does_not_block_the_others(tmp_path):
+    db, rejects = str(tmp_path / "trades.db"), str(tmp_path / "rejected.csv")
+    journal = TradeJournal(SQLiteBackend(db), "T", flush_interval = 0.01, reject_file = rejects)
+    journal.record("EUR_USD", datetime(2024, 1, 1), 1, 1.1, 0.0, 0.0)
+    journal.record("EUR_USD", datetime(2024, 1, 1), 2, {"not": "bindable"}, 0.0, 0.0)
+    for units in range(3, 7):
+        journal.record("EUR_USD", datetime(2024, 1, 1), units, 1.1, 0.0, 0.0)
+    journal.close()
+    assert (journal.written, journal.rejected) == (5, 1)
+    assert rows(db, "T") == [(1,), (3,), (4,), (5,), (6,)]
+    assert "bindable" in open(rejects).read()
+
+
+class FlakyBackend(SQLiteBackend):
+    # the connection drops on the first `drops` writes after the table is created
+    def __init__(self, path, drops):
+        super().__init__(path)
+        self.drops = drops
+        self.largest = 0
+
+    def connect(self):
+        conn = super().connect()
+        backend = self
+
+        class Conn:
+            def cursor(self):
+                return Cursor(conn.cursor())
+
+            def __getattr__(self, name):
+                return getattr(conn, name)
+
+        class Cursor:
+            def __init__(self, cursor):
+                self.cursor = cursor
+
+            def executemany(self, sql, batch):
+                backend.largest = max(backend.largest, len(batch))
+                if backend.drops:
+                    backend.drops -= 1
+                    raise ConnectionError("connection reset")
+                return self.cursor.executemany(sql, batch)
+
+            def __getattr__(self, name):
+                return getattr(self.cursor, name)
+
+        return Conn()
+
+
+def test_lost_connection_is_retried_in_capped_batches(tmp_path):
+    db = str(tmp_path / "trades.db")
+    backend = FlakyBackend(db, drops = 2)
+    journal = TradeJournal(backend, "T", batch_size = 4, flush_interval = 0.01)
+    for units in range(10):
+        journal.record("EUR_USD", datetime(2024, 1, 1), units, 1.1, 0.0, 0.0)
+    journal.close()
+    assert (journal.written, journal.rejected) == (10, 0)
+    assert len(rows(db, "T")) == 10
+    assert backend.largest == 4
@@ -0,0 +1,77 @@
+import time
+import numpy as np
+from orders import OrderManager, MockBroker
+
+
+def fast(**kwargs):
+    return MockBroker(**{"latency": 0.001, "jitter": 0.0, "seed": 0, **kwargs})
+
+
+def test_flip_and_flip_back_net_to_one_order():
+    broker = fast(latency = 0.2)
+    manager = OrderManager(broker, "EUR_USD")
+    manager.target(100000)
+    manager.target(-100000) # queued behind the first order ...
+    manager.target(100000) # ... and cancelled out again
+    manager.close()
+    assert [order.units for order in manager.orders] == [100000]
+    assert broker.calls == 1 and manager.position == broker.units == 100000
+
+
+def test_late_fill_of_timed_out_attempt_is_not_doubled():
+    broker = fast(slow_rate = 1.0, slow_latency = 0.3)
+    manager = OrderManager(broker, "EUR_USD", timeout = 0.05, retries = 1, backoff = 0.01, background = False)
+    order = manager.target(100000)
+    assert order.status == "filled" and manager.stats["timeouts"] == 2
+    assert manager.target(100000) is None # nothing is missing
+    assert len(broker.fills) == 1 and manager.position == broker.units == 100000
+
+
+def test_unresolved_order_stays_pending():
+    broker = fast(slow_rate = 1.0, slow_latency = 0.5)
+    manager = OrderManager(broker, "EUR_USD", timeout = 0.05, retries = 0, settle_timeout = 0.1)
+    first = manager.target(100000)
+    manager.flush()
+    assert first.status == "unresolved" and manager.pending() == 100000 and manager.pending() == 100000
+    broker.slow_rate = 0.0
+    assert manager.target(100000) is None
+    manager.target(-100000) # sent at once, netted against the unresolved units
+    manager.flush()
+    assert manager.orders[-1].units == -200000
+    manager.close()
+    deadline = time.perf_counter() + 5
+    while first.status == "unresolved" and time.perf_counter() < deadline: # its call returns after 0.5s
+        time.sleep(0.01)
+    assert first.status == "filled" and manager.pending() == 0
+    assert manager.position == broker.units == -100000
+
+
+def test_rejection_is_not_retried():
+    broker = fast(reject_rate = 1.0)
+    manager = OrderManager(broker, "EUR_USD", background = False)
+    assert manager.target(100000).status == "rejected"
+    assert broker.calls == 1 and manager.position == 0
+    broker.reject_rate = 0.0
+    assert manager.target(100000).units == 100000 # the next target sends what is missing
+    assert manager.position == broker.units == 100000
+
+
+def test_lost_response_is_resolved_by_lookup():
+    broker = fast(lost_rate = 1.0)
+    manager = OrderManager(broker, "EUR_USD", backoff = 0.001, background = False)
+    order = manager.target(100000)
+    assert order.status == "filled" and order.attempts == 1 and broker.calls == 1
+    assert manager.position == broker.units == 100000
+
+
+def test_position_matches_broker_after_flaky_session():
+    broker = fast(latency = 0.002, jitter = 0.001, error_rate = 0.2, lost_rate = 0.2, reject_rate = 0.05,
+                  slow_rate = 0.1, slow_latency = 0.05, seed = 1)
+    manager = OrderManager(broker, "EUR_USD", timeout = 0.02, backoff = 0.001)
+    rng = np.random.default_rng(2)
+    for _ in range(100):
+        manager.target(int(rng.integers(-1, 2)) * 100000)
+    manager.target(0)
+    manager.close()
+    assert manager.stats["filled"] == len(broker.fills)
+    assert manager.position == broker.units